@@ -0,0 +1,249 @@
+'''Хранение действий этапа в столбцах массивов NumPy.
+
+На этапе выбора букв действий десятки тысяч, и у каждого - кортеж
+прямоугольников. Вместо словаря объектов Action действия хранятся
+в структурированном массиве (тип, вид значения, число или пара чисел,
+признак final) с одной строкой на индекс файла, а прямоугольники букв -
+в общем массиве (N, 4) со смещением и числом прямоугольников для каждого
+действия. Снаружи хранилище ведет себя как словарь {индекс: Action}:
+объекты Action создаются при чтении. Значения необычного вида хранятся
+как есть в обычном словаре.
+'''
+from collections.abc import MutableMapping
+from typing import NamedTuple, Union
+
+import numpy as np
+
+
+class Action(NamedTuple):
+    type: str  # "cut", "crop", "rotate"
+    value: Union[int, float, tuple]  # Число или кортеж
+    final: bool
+
+
+# Вид значения действия
+ABSENT, INT, FLOAT, INT_PAIR, FLOAT_PAIR, RECTS, OTHER = range(-1, 6)
+
+ACTION_DTYPE = np.dtype([
+    ('form', np.int8),  # вид значения, ABSENT - действия нет
+    ('kind', np.int8),  # номер типа действия в ActionStore.types
+    ('final', np.bool_),
+    ('x', np.float64),  # число или первый элемент пары
+    ('y', np.float64),
+    ('start', np.int32),  # первый прямоугольник в ActionStore.rects
+    ('count', np.int32),  # число прямоугольников
+])
+MIN_CAPACITY = 16
+MIN_COMPACT = 4096  # неиспользуемых прямоугольников, после которых массив уплотняется
+
+
+def value_form(value):
+    """Вид значения и массив прямоугольников (для RECTS)."""
+    if type(value) is int:
+        return INT, None
+    if type(value) is float:
+        return FLOAT, None
+    if type(value) is not tuple:
+        return OTHER, None
+    if len(value) == 2 and all(type(v) is int for v in value):
+        return INT_PAIR, None
+    if len(value) == 2 and all(type(v) is float for v in value):
+        return FLOAT_PAIR, None
+    if not value:
+        return RECTS, np.empty((0, 4), dtype=np.int32)
+    if not all(type(box) is tuple and len(box) == 4 for box in value):
+        return OTHER, None
+    boxes = np.array(value)
+    if boxes.dtype.kind != 'i' or np.abs(boxes).max() >= 2 ** 31:
+        return OTHER, None
+    return RECTS, boxes.astype(np.int32)
+
+
+class ActionStore(MutableMapping):
+    """Словарь {индекс_изображения: действие} в массивах, запоминающий измененные индексы."""
+
+    def __init__(self, actions=None):
+        self.columns = np.zeros(MIN_CAPACITY, dtype=ACTION_DTYPE)
+        self.columns['form'] = ABSENT
+        self.types = []  # типы действий, в columns['kind'] - номер в этом списке
+        self.rects = np.zeros((MIN_CAPACITY, 4), dtype=np.int32)
+        self.rects_used = 0  # занятая часть rects
+        self.rects_garbage = 0  # прямоугольники удаленных и замененных действий
+        self.other = dict()  # {индекс: значение} для значений вида OTHER
+        self.dirty = set()
+        if actions:
+            self._load(dict(actions))
+
+    def _load(self, actions):
+        """Заполняет пустое хранилище, выделяя массивы сразу нужного размера."""
+        self.columns = np.zeros(max(int(key) for key in actions) + 1, dtype=ACTION_DTYPE)
+        self.columns['form'] = ABSENT
+        boxes = []
+        for key, action in actions.items():
+            action = Action(*action)
+            form, rects = value_form(action.value)
+            if form == RECTS:
+                # Прямоугольники копируются в общий массив одним действием ниже
+                boxes.append(rects)
+                self.columns[key] = (RECTS, self._type_number(action.type), bool(action.final), 0.0, 0.0,
+                                     self.rects_used, len(rects))
+                self.rects_used += len(rects)
+            else:
+                self._store(key, action)
+        if boxes:
+            self.rects = np.concatenate(boxes)
+
+    def _grow(self, size):
+        capacity = len(self.columns)
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        columns = np.zeros(capacity, dtype=ACTION_DTYPE)
+        columns['form'] = ABSENT
+        columns[:len(self.columns)] = self.columns
+        self.columns = columns
+
+    def _type_number(self, action_type):
+        try:
+            return self.types.index(action_type)
+        except ValueError:
+            self.types.append(action_type)
+            return len(self.types) - 1
+
+    def _release(self, key):
+        """Освобождает место, занятое значением действия key."""
+        row = self.columns[key]
+        if row['form'] == RECTS:
+            self.rects_garbage += int(row['count'])
+        elif row['form'] == OTHER:
+            del self.other[key]
+
+    def _put_rects(self, key, boxes):
+        row = self.columns[key]
+        if row['form'] == RECTS and len(boxes) <= row['count']:
+            # Новые прямоугольники помещаются на место старых
+            start = int(row['start'])
+            self.rects_garbage += int(row['count']) - len(boxes)
+        else:
+            self._release(key)
+            start = self.rects_used
+            if start + len(boxes) > len(self.rects):
+                rects = np.zeros((max(2 * len(self.rects), start + len(boxes)), 4), dtype=np.int32)
+                rects[:start] = self.rects[:start]
+                self.rects = rects
+            self.rects_used += len(boxes)
+        self.rects[start:start + len(boxes)] = boxes
+        return start
+
+    def _store(self, key, action):
+        key = int(key)
+        if key < 0:
+            raise KeyError(key)
+        action = Action(*action)
+        self._grow(key + 1)
+        form, boxes = value_form(action.value)
+        start = count = 0
+        x = y = 0.0
+        if form == RECTS:
+            start, count = self._put_rects(key, boxes), len(boxes)
+        else:
+            self._release(key)
+            if form in (INT, FLOAT):
+                x = action.value
+            elif form in (INT_PAIR, FLOAT_PAIR):
+                x, y = action.value
+            else:
+                self.other[key] = action.value
+        self.columns[key] = (form, self._type_number(action.type), bool(action.final), x, y, start, count)
+        self._compact()
+
+    def _compact(self):
+        if self.rects_garbage < max(MIN_COMPACT, self.rects_used // 2):
+            return
+        rows = np.flatnonzero(self.columns['form'] == RECTS)
+        starts, counts = self.columns['start'][rows], self.columns['count'][rows]
+        new_starts = np.concatenate(([0], np.cumsum(counts)[:-1])) if len(rows) else starts
+        # Индексы всех занятых прямоугольников по порядку действий
+        used = np.repeat(starts - new_starts, counts) + np.arange(int(counts.sum()))
+        self.rects = self.rects[used]
+        self.rects_used = len(self.rects)
+        self.rects_garbage = 0
+        self.columns['start'][rows] = new_starts
+
+    def __getitem__(self, key):
+        if not isinstance(key, (int, np.integer)) or not 0 <= key < len(self.columns):
+            raise KeyError(key)
+        row = self.columns[key]
+        form = int(row['form'])
+        if form == ABSENT:
+            raise KeyError(key)
+        if form == INT:
+            value = int(row['x'])
+        elif form == FLOAT:
+            value = float(row['x'])
+        elif form == INT_PAIR:
+            value = (int(row['x']), int(row['y']))
+        elif form == FLOAT_PAIR:
+            value = (float(row['x']), float(row['y']))
+        elif form == RECTS:
+            start = int(row['start'])
+            value = tuple(map(tuple, self.rects[start:start + int(row['count'])].tolist()))
+        else:
+            value = self.other[int(key)]
+        return Action(self.types[row['kind']], value, bool(row['final']))
+
+    def __setitem__(self, key, action):
+        self._store(key, action)
+        self.dirty.add(int(key))
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        key = int(key)
+        self._release(key)
+        self.columns[key] = (ABSENT, 0, False, 0.0, 0.0, 0, 0)
+        self.dirty.add(key)
+
+    def __contains__(self, key):
+        return (isinstance(key, (int, np.integer)) and 0 <= key < len(self.columns) and
+                self.columns['form'][key] != ABSENT)
+
+    def __iter__(self):
+        return iter(self.indices().tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self.columns['form'] != ABSENT))
+
+    def __repr__(self):
+        return f'{type(self).__name__}({dict(self.items())!r})'
+
+    def indices(self, final=None):
+        """Индексы действий (массив); final=True/False - только готовые/неготовые."""
+        present = self.columns['form'] != ABSENT
+        if final is not None:
+            present &= self.columns['final'] == final
+        return np.flatnonzero(present)
+
+    def finalize(self, indices=None):
+        """
+        Отмечает действия готовыми одной операцией над массивом.
+
+        :param indices: Индексы файлов; None - все действия
+        :return: Список индексов, действия которых изменились
+        """
+        if indices is None:
+            changed = self.indices(final=False)
+        else:
+            indices = np.asarray(list(indices), dtype=np.int64)
+            indices = indices[(indices >= 0) & (indices < len(self.columns))]
+            rows = self.columns[indices]
+            changed = np.unique(indices[(rows['form'] != ABSENT) & ~rows['final']])
+        self.columns['final'][changed] = True
+        changed = changed.tolist()
+        self.dirty.update(changed)
+        return changed
+
+    def nbytes(self):
+        """Память под массивы хранилища, байт (без значений вида OTHER)."""
+        return self.columns.nbytes + self.rects.nbytes
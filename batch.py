@@ -0,0 +1,155 @@
+'''Пакетная обработка проекта без графического интерфейса.
+
+Загружает проект (.db или старый .blr), применяет записанные действия текущего этапа
+и формирует папку следующего этапа. Пример запуска на сервере:
+
+    python batch.py /data/blanks/processing/blanks.db --all
+'''
+import argparse
+import os
+import sys
+
+from classes import Project, STEPS, TEXT_STEPS
+
+
+def letter_size(text):
+    """Размеры букв MIN_W,MAX_W,MIN_H,MAX_H для argparse."""
+    try:
+        sizes = tuple(int(v) for v in text.split(','))
+    except ValueError:
+        sizes = ()
+    if len(sizes) != 4 or min(sizes) < 1 or sizes[0] > sizes[1] or sizes[2] > sizes[3]:
+        raise argparse.ArgumentTypeError(f'нужны 4 целых числа MIN_W,MAX_W,MIN_H,MAX_H '
+                                         f'(минимум не больше максимума), получено "{text}"')
+    return sizes
+
+
+def threshold(text):
+    """Порог выделения букв для argparse: 'otsu', 'adaptive' или яркость 0-255."""
+    if text in ('otsu', 'adaptive'):
+        return text
+    if text.isdigit() and int(text) <= 255:
+        return int(text)
+    raise argparse.ArgumentTypeError(f'нужно otsu, adaptive или число от 0 до 255, получено "{text}"')
+
+
+def open_project(path):
+    """Загружает проект по пути к файлу проекта или к папке со сканами."""
+    path = os.path.abspath(path).replace('\\', '/')
+    if os.path.isdir(path):
+        work_dir = path
+        file_name = None
+    else:
+        # Файл проекта лежит в <папка со сканами>/processing/
+        work_dir = os.path.dirname(os.path.dirname(path))
+        file_name = path
+    project = Project()
+    project.work_dir = work_dir
+    if not project.load_project(file_name):
+        return None
+    if project.work_dir != work_dir:
+        project.relocate(work_dir)
+    return project
+
+
+def run_steps(project, last_step, thumbnails=False, workers=None):
+    """Применяет этапы проекта, пока не будет достигнут этап last_step."""
+    while project.current_step < last_step:
+        if project.files is None:
+            project.load_current_files()
+        if project.check_list is None or len(project.check_list) != len(project.files):
+            # В пакетном режиме обрабатываются все файлы этапа
+            project.set_check_list([True] * len(project.files))
+        print(f'Этап "{TEXT_STEPS[project.current_step]}": файлов {len(project.files)}, '
+              f'действий {len(project.actions)}')
+        if not project.next_step(thumbnails=thumbnails, workers=workers):
+            print(f'Ошибка при переходе с этапа "{TEXT_STEPS[project.current_step]}"')
+            return False
+        if project.errors:
+            print(f'Не обработано файлов: {len(project.errors)}')
+    return True
+
+
+def print_trace(project, file):
+    source, chain = project.trace_file(os.path.abspath(file).replace('\\', '/'))
+    if not chain:
+        print(f'Происхождение файла {file} неизвестно')
+        return
+    print(f'Исходный скан: {source}')
+    for step, file_name, action_key, res_name in chain:
+        operation = 'без изменений' if action_key is None else f'{action_key[0]} {action_key[1]}'
+        print(f'  {TEXT_STEPS[step]}: {file_name} -> {operation} -> {res_name}')
+
+
+def print_dependents(project, source_name):
+    files = project.get_dependent_files(source_name)
+    for step, path, action_key in files:
+        print(f'{TEXT_STEPS[step]}: {path}')
+    print(f'Всего файлов: {len(files)}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Пакетная обработка проекта Cropper без интерфейса')
+    parser.add_argument('project', help='файл проекта (.db или .blr) или папка со сканами')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--all', action='store_true',
+                       help='применить все этапы до вывода результата')
+    group.add_argument('--until', choices=STEPS[1:],
+                       help='применять этапы, пока не будет достигнут указанный этап')
+    parser.add_argument('--thumbnails', action='store_true',
+                        help='сразу сгенерировать иконки для интерфейса')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='число процессов обработки (по умолчанию - по числу ядер)')
+    parser.add_argument('--virtual', action='store_true',
+                        help='сохранять разрезы и повороты описаниями .vimg вместо изображений')
+    parser.add_argument('--letters', action='store_true',
+                        help='на этапе выбора букв выделить буквы во всех неподтвержденных файлах')
+    parser.add_argument('--letter-size', metavar='MIN_W,MAX_W,MIN_H,MAX_H', type=letter_size,
+                        help='допустимые размеры букв проекта в пикселях, например 50,100,60,170')
+    parser.add_argument('--threshold', metavar='otsu|adaptive|ЧИСЛО', type=threshold,
+                        help='порог выделения букв проекта: по Оцу, адаптивный или яркость 0-255')
+    group.add_argument('--trace', metavar='FILE',
+                       help='показать, из какого скана и какими операциями получен файл')
+    group.add_argument('--dependents', metavar='SCAN',
+                       help='показать все файлы, полученные из исходного скана (имя файла)')
+    args = parser.parse_args(argv)
+
+    project = open_project(args.project)
+    if project is None:
+        print(f'Не удалось загрузить проект {args.project}')
+        return 1
+    if args.trace is not None:
+        print_trace(project, args.trace)
+        return 0
+    if args.dependents is not None:
+        print_dependents(project, os.path.basename(args.dependents))
+        return 0
+    if args.virtual and not project.virtual_crops:
+        project.set_virtual_crops(True)
+    if args.letter_size is not None or args.threshold is not None:
+        limits = project.letter_limits
+        if args.letter_size is not None:
+            limits = limits._replace(**dict(zip(('min_width', 'max_width', 'min_height', 'max_height'),
+                                                args.letter_size)))
+        if args.threshold is not None:
+            limits = limits._replace(threshold=args.threshold)
+        project.set_letter_limits(limits)
+    if args.all:
+        last_step = len(STEPS) - 1
+    elif args.until is not None:
+        last_step = STEPS.index(args.until)
+    else:
+        last_step = project.current_step + 1
+    last_step = min(last_step, len(STEPS) - 1)
+    if not run_steps(project, last_step, thumbnails=args.thumbnails, workers=args.workers):
+        return 1
+    if args.letters and STEPS[project.current_step] == 'letter_select':
+        review = project.segment_letters(workers=args.workers)
+        project.save_project()
+        print(f'Буквы выделены, не найдены в файлах: {len(review)}')
+    print(f'Текущий этап: {TEXT_STEPS[project.current_step]}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
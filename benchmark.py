@@ -0,0 +1,80 @@
+'''Замер скорости преобразования изображений PIL и OpenCV в QPixmap.
+
+Сравнивает прежнее преобразование (разделение каналов, BGR, RGBA, tobytes)
+с передачей буфера в QImage в родном формате. Пример запуска:
+
+    python benchmark.py --size 3000x2000 --repeat 20
+'''
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+from PyQt6.QtGui import QGuiApplication, QImage, QPixmap
+
+from functions import cv2_to_qpixmap, pil2pixmap
+
+
+def legacy_pil2pixmap(image):
+    """Преобразование, которое использовалось до замены pil2pixmap."""
+    if image.mode == "RGB":
+        r, g, b = image.split()
+        im = Image.merge("RGB", (b, g, r))
+    elif image.mode == "RGBA":
+        r, g, b, a = image.split()
+        im = Image.merge("RGBA", (b, g, r, a))
+    else:
+        im = image.convert("RGBA")
+    im2 = im.convert("RGBA")
+    data = im2.tobytes("raw", "RGBA")
+    qim = QImage(data, im.size[0], im.size[1], QImage.Format.Format_ARGB32)
+    return QPixmap.fromImage(qim)
+
+
+def legacy_cv2_to_qpixmap(cv_img):
+    import cv2
+    rgb_img = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
+    height, width, channels = rgb_img.shape
+    q_img = QImage(rgb_img.data, width, height, channels * width, QImage.Format.Format_RGB888)
+    return QPixmap.fromImage(q_img)
+
+
+def measure(func, arg, repeat):
+    func(arg)  # прогрев
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(arg)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Скорость преобразования изображений в QPixmap')
+    parser.add_argument('--size', default='3000x2000', help='размер тестового скана, ШИРИНАxВЫСОТА')
+    parser.add_argument('--repeat', type=int, default=20, help='число повторов каждого замера')
+    args = parser.parse_args(argv)
+    width, height = (int(v) for v in args.size.lower().split('x'))
+
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QGuiApplication(sys.argv[:1])
+    rng = np.random.default_rng(0)
+    rgb = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    cases = [
+        ('PIL RGB', legacy_pil2pixmap, pil2pixmap, Image.fromarray(rgb)),
+        ('PIL RGBA', legacy_pil2pixmap, pil2pixmap, Image.fromarray(rgb).convert('RGBA')),
+        ('PIL L', legacy_pil2pixmap, pil2pixmap, Image.fromarray(rgb).convert('L')),
+        ('OpenCV BGR', legacy_cv2_to_qpixmap, cv2_to_qpixmap, rgb),
+    ]
+    print(f'{width}x{height}, повторов: {args.repeat}')
+    print(f'{"":12} {"было, мс":>10} {"стало, мс":>10} {"ускорение":>10}')
+    for name, old, new, image in cases:
+        old_ms = measure(old, image, args.repeat)
+        new_ms = measure(new, image, args.repeat)
+        print(f'{name:12} {old_ms:10.1f} {new_ms:10.1f} {old_ms / new_ms:9.1f}x')
+    del app
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+'''Хранилище изображений по хэшу содержимого.
+
+Файл хранится один раз в processing/blobs/<2 символа>/<хэш><расширение>,
+а в папках этапов лежат жесткие ссылки на него. Неизмененные изображения
+переходят на следующий этап без копирования, одинаковые результаты не дублируются.
+Если файловая система не поддерживает жесткие ссылки, файлы копируются как раньше.
+'''
+import os
+import shutil
+
+from functions import file_digest
+
+
+def link_file(src, dest):
+    """Создает dest как жесткую ссылку на src (или копию, если ссылки не поддерживаются)."""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return True
+    except OSError:
+        shutil.copy2(src, dest)
+        return False
+
+
+class BlobStore:
+    def __init__(self, root):
+        self.root = root
+
+    def blob_path(self, blob_id, ext):
+        return self.root + '/' + blob_id[:2] + '/' + blob_id + ext.lower()
+
+    def contains(self, path, blob_id):
+        """Проверяет, что path - ссылка на изображение blob_id."""
+        blob = self.blob_path(blob_id, os.path.splitext(path)[1])
+        try:
+            return os.path.samefile(path, blob)
+        except OSError:
+            return False
+
+    def add_file(self, path, dest):
+        """Помещает файл path в хранилище и создает dest как ссылку на него."""
+        blob_id = file_digest(path)
+        blob = self.blob_path(blob_id, os.path.splitext(path)[1])
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+            except OSError:
+                # Без жестких ссылок хранилище только удвоило бы объем
+                shutil.copy2(path, dest)
+                return blob_id
+        link_file(blob, dest)
+        return blob_id
+
+    def adopt(self, path):
+        """
+        Переносит записанный файл этапа в хранилище: если такое изображение уже есть,
+        файл заменяется ссылкой на него, иначе файл становится новым изображением хранилища.
+        """
+        blob_id = file_digest(path)
+        blob = self.blob_path(blob_id, os.path.splitext(path)[1])
+        if os.path.exists(blob):
+            if not os.path.samefile(path, blob):
+                link_file(blob, path)
+        else:
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            try:
+                os.link(path, blob)
+            except OSError:
+                pass
+        return blob_id
+
+    def collect_garbage(self):
+        """Удаляет изображения, на которые не ссылается ни один этап."""
+        if not os.path.isdir(self.root):
+            return 0
+        removed = 0
+        for sub_dir in os.listdir(self.root):
+            sub_path = os.path.join(self.root, sub_dir)
+            for name in os.listdir(sub_path):
+                blob = os.path.join(sub_path, name)
+                if os.stat(blob).st_nlink <= 1:
+                    os.remove(blob)
+                    removed += 1
+        return removed
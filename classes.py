@@ -1,31 +1,69 @@
-from math import ceil
-
 import cv2
 from PyQt6.QtCore import *
 from PyQt6.QtWidgets import *
 from PyQt6.QtGui import QPixmap, QBrush, QImage, QPen
 import pickle
 import os
-import shutil
+import sqlite3
 from PIL import Image
 from typing import Callable, NamedTuple, Union
 from functions import *
+import pipeline
+import layout
+import vimage
+import cutdetect
+import deskew
+import gridreg
+import segment
+import imagecache
+from pyramid import TiledImageItem, fit_size, get_pyramid
+from storage import ProjectStore
+from actionstore import Action, ActionStore
+from blobstore import BlobStore, link_file
+import thumbnails
 
 STEPS = ["vertical_cut", "horizontal_cut", "orientation", "rotation",
          "word_select", "letter_select", "output"]
 TEXT_STEPS = ["вертикальный разрез", "горизонтальный разрез",
               "ориентация бланка", "вращение", "выбор слов",
               "выбор букв", "вывод результата"]
-GRID_WIDTH = 3240
-GRID_HEIGHT = 2000
 ANGLE_SCALE = 1
 DELTA_ANGLE = 0.1
 
 
-class Action(NamedTuple):
-    type: str  # "cut", "crop", "rotate"
-    value: Union[int, float, tuple]  # Число или кортеж
-    final: bool
+class ProjectChanges(NamedTuple):
+    info: Union[tuple, None]  # (папка, этап, список отметок) или None, если не менялись
+    step: int  # этап, к которому относятся действия
+    actions: dict  # {индекс: (имя файла, действие или None)}
+    fingerprints: dict  # {этап: отпечатки}
+
+
+class RectIndex:
+    """
+    Сеточный индекс прямоугольников (QRectF): каждый прямоугольник записан в ячейки
+    сетки, которые он задевает, поэтому поиск по точке проверяет только одну ячейку.
+    """
+
+    def __init__(self, rects, cell_size=None):
+        self.rects = list(rects)
+        if cell_size is None:
+            # Ячейка порядка среднего прямоугольника: в ячейку попадает всего несколько прямоугольников
+            sizes = [max(r.width(), r.height()) for r in self.rects]
+            cell_size = max(1.0, sum(sizes) / len(sizes)) if sizes else 1.0
+        self.cell_size = cell_size
+        self.cells = dict()  # {(столбец, строка): [индексы прямоугольников]}
+        for i, r in enumerate(self.rects):
+            for column in range(int(r.left() // cell_size), int(r.right() // cell_size) + 1):
+                for row in range(int(r.top() // cell_size), int(r.bottom() // cell_size) + 1):
+                    self.cells.setdefault((column, row), []).append(i)
+
+    def find(self, point):
+        """Индекс последнего прямоугольника, содержащего точку, или None."""
+        cell = (int(point.x() // self.cell_size), int(point.y() // self.cell_size))
+        for i in reversed(self.cells.get(cell, ())):
+            if self.rects[i].contains(point):
+                return i
+        return None
 
 
 class Mylabel(QLabel):
@@ -46,11 +84,21 @@ class Project:
         self.steps = STEPS
         self.text_steps = TEXT_STEPS
         self.actions = None  # действия на текущем этапе
-        self.history = None  # словарь {этап: actions}
+        self.errors = []  # (файл, ошибка) при последнем переходе на следующий этап
+        self.review = []  # индексы файлов этапа с автоматическими предложениями для проверки
+        # {этап: {имя файла: (размер и время изменения, хэш, действие, [имена результатов])}}
+        self.fingerprints = dict()
+        self.dirty_fingerprints = set()  # этапы, отпечатки которых нужно сохранить
+        self.store = None
+        self.saved_info = None  # (папка, этап, список отметок), записанные в базу
+        # Разрезы и повороты сохраняются описаниями .vimg, изображения записываются на этапе выбора слов
+        self.virtual_crops = False
+        self.letter_limits = segment.DEFAULT_LIMITS  # порог и размеры букв проекта
+        self.image_sizes = []  # размеры файлов текущего этапа из заголовков
         if directory_name is not None:
             self.load_project()
         else:
-            self.actions = dict()  # {индекс_изображения: действие}
+            self.actions = ActionStore()  # {индекс_изображения: действие}
 
     def add_action_to_image(self, image_index, action: Action):
         self.actions[image_index] = action
@@ -59,23 +107,18 @@ class Project:
         if image_index in self.actions:
             self.actions.pop(image_index)
 
-    def create_viewer(self, path, image_index, container_size):
-        if image_index in self.actions.keys():
+    def create_viewer(self, path, image_index, container_size, viewer=None):
+        """Окно просмотра файла; если передано окно viewer, файл показывается в нем без пересоздания."""
+        if viewer is None:
             return ImageViewer(path, image_index, self.add_action_to_image, self.remove_action_from_image,
-                               self.current_step, current_action=self.actions[image_index],
-                               container_size=container_size)
-        return ImageViewer(path, image_index, self.add_action_to_image, self.remove_action_from_image,
-                           self.current_step, container_size=container_size)
-
-    def __getstate__(self) -> dict:
-        state = dict()
-        state["work_dir"] = self.work_dir
-        state["file_project_name"] = self.file_project_name
-        state["current_step"] = self.current_step
-        state["files"] = self.files
-        state["check_list"] = self.check_list
-        state["history"] = self.history
-        return state
+                               self.current_step, current_action=self.actions.get(image_index),
+                               container_size=container_size, letter_limits=self.letter_limits)
+        # Окно могло показывать файл другого проекта
+        viewer.on_action_added = self.add_action_to_image
+        viewer.on_action_removed = self.remove_action_from_image
+        viewer.letter_limits = self.letter_limits
+        viewer.set_image(path, image_index, self.current_step, self.actions.get(image_index), container_size)
+        return viewer
 
     def get_current_files(self):
         # files, _, __ = zip(*self.action_steps[self.current_step])
@@ -97,45 +140,179 @@ class Project:
         return self.work_dir + '/processing/' + self.steps[self.current_step]
 
     def __setstate__(self, state: dict):
-        self.work_dir = state["work_dir"]
-        self.file_project_name = state["file_project_name"]
-        self.current_step = state["current_step"]
-        # self.actions = state["actions"]
-        self.files = state["files"]
-        self.check_list = state["check_list"]
-        self.history = state["history"]
-        self.actions = self.history[self.current_step]
-
-    def load_project(self):
-        file_name = self.get_possible_project_name()
+        # Старые файлы проекта .blr читаются только для переноса в базу (migrate_project)
+        self.legacy_state = state
+
+    def load_project(self, file_name=None):
+        if file_name is None:
+            file_name = self.get_possible_project_name()
+        db_name = os.path.splitext(file_name)[0] + '.db'
+        if not os.path.isfile(db_name):
+            legacy_name = os.path.splitext(file_name)[0] + '.blr'
+            if not os.path.isfile(legacy_name) or not self.migrate_project(legacy_name, db_name):
+                print(f'Проект {file_name} не найден')
+                return False
+        self.close_project()
         try:
-            with open(file_name, "rb") as fp:
-                temp = pickle.load(fp)
-                self.work_dir = temp.work_dir
-                self.file_project_name = temp.file_project_name
-                self.current_step = temp.current_step
-                self.files = temp.files
-                self.check_list = temp.check_list
-                self.history = temp.history
-                self.actions = self.history[self.current_step]
-                return True
-        except OSError as e:
-            print("OS error({0}): {1}".format(e.errno, e.strerror))
+            self.store = ProjectStore(db_name)
+            info = self.store.load_info()
+            if info is None:
+                return False
+            self.work_dir, self.current_step, self.check_list = info
+            self.saved_info = (self.work_dir, self.current_step, self.check_list)
+            if not os.path.isdir(self.work_dir + '/processing'):
+                # Проект скопирован на другую машину - папка определяется по расположению базы
+                self.work_dir = os.path.dirname(os.path.dirname(os.path.abspath(db_name))).replace('\\', '/')
+            self.file_project_name = db_name
+            self.fingerprints = self.store.load_fingerprints()
+            self.dirty_fingerprints = set()
+            self.virtual_crops = self.store.get_setting('virtual_crops', False)
+            self.letter_limits = segment.LetterLimits(**self.store.get_setting('letter_limits', dict()))
+            if self.fingerprints and not self.store.has_lineage():
+                self.rebuild_lineage()
+            self.load_current_files()
+            self.actions = self.restore_actions(self.current_step)
+            return True
+        except (OSError, sqlite3.Error) as e:
+            print(f"Ошибка загрузки проекта: {e}")
             return False
 
-    def save_project(self):
+    def legacy_step_names(self, state, step):
+        """Имена файлов этапа в порядке старой версии (os.listdir), по которому нумеровались действия."""
+        if step == state["current_step"] and state.get("files"):
+            return [os.path.basename(f) for f in state["files"]]
+        step_dir = state["work_dir"] + '/processing/' + self.steps[step]
+        if not os.path.isdir(step_dir):
+            return []
+        return [f for f in os.listdir(step_dir) if os.path.isfile(os.path.join(step_dir, f))]
+
+    def migrate_project(self, legacy_name, db_name):
+        """Однократно переносит проект из файла .blr (pickle) в базу SQLite."""
         try:
-            if self.history is None:
-                self.history = dict()
-            self.history[self.current_step] = self.actions
-            with open(self.file_project_name, "wb") as fp:
-                pickle.dump(self, fp)
-                return True
-        except OSError as e:
-            print("OS error({0}): {1}".format(e.errno, e.strerror))
+            with open(legacy_name, "rb") as fp:
+                state = pickle.load(fp).legacy_state
+            store = ProjectStore(db_name)
+        except (OSError, EOFError, AttributeError, ModuleNotFoundError, pickle.UnpicklingError,
+                sqlite3.Error) as e:
+            print(f"Ошибка переноса проекта {legacy_name}: {e}")
+            return False
+        current_step = state["current_step"]
+        # Старая версия хранила действия всех этапов (history), промежуточная - только текущего
+        history = state.get("history") or {current_step: state.get("actions") or dict()}
+        names = self.legacy_step_names(state, current_step)
+        check_list = state["check_list"]
+        if check_list is not None:
+            # Отметки шли в порядке os.listdir, а файлы этапа теперь упорядочены по имени
+            checked = dict(zip(names, check_list))
+            check_list = [checked.get(name, False) for name in sorted(names)]
+        try:
+            with store.transaction():
+                store.save_info(state["work_dir"], current_step, check_list)
+                for step, actions in history.items():
+                    step_names = names if step == current_step else self.legacy_step_names(state, step)
+                    for index, action in (actions or dict()).items():
+                        if index < len(step_names):
+                            store.save_action(step, step_names[index], Action(*action))
+                for step, entries in state.get("fingerprints", dict()).items():
+                    store.save_fingerprints(step, entries)
+        except sqlite3.Error as e:
+            print(f"Ошибка переноса проекта {legacy_name}: {e}")
+            store.close()
+            os.remove(db_name)
+            return False
+        store.close()
+        return True
+
+    def rebuild_lineage(self):
+        """Восстанавливает индекс происхождения файлов по отпечаткам (для проектов старого формата)."""
+        with self.store.transaction():
+            self.store.add_sources(self.work_dir + '/' + name for name in self.fingerprints.get(0, dict()))
+            for step in sorted(self.fingerprints):
+                for name, entry in self.fingerprints[step].items():
+                    self.store.record_results(step, name, entry[2], entry[3])
+
+    def close_project(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def collect_changes(self):
+        """
+        Изменения проекта с последнего сохранения; отметки изменений сбрасываются.
+        Вызывается в потоке интерфейса, записать изменения можно в любом потоке (write_changes).
+        """
+        info = (self.work_dir, self.current_step, self.check_list)
+        changed_info = (self.saved_info is None or info[:2] != self.saved_info[:2] or
+                        info[2] is not self.saved_info[2])
+        names = [os.path.basename(f) for f in self.files or []]
+        changes = ProjectChanges(
+            info=(info[0], info[1], None if info[2] is None else list(info[2])) if changed_info else None,
+            step=self.current_step,
+            actions={index: (names[index], self.actions.get(index)) for index in self.actions.dirty
+                     if index < len(names)},
+            fingerprints={step: dict(self.fingerprints.get(step, dict())) for step in self.dirty_fingerprints})
+        self.saved_info = info
+        self.actions.dirty.clear()
+        self.dirty_fingerprints.clear()
+        return changes
+
+    def write_changes(self, changes):
+        """Записывает изменения одной транзакцией базы."""
+        try:
+            if self.store is None:
+                self.store = ProjectStore(self.file_project_name)
+            with self.store.transaction():
+                if changes.info is not None:
+                    self.store.save_info(*changes.info)
+                for name, action in changes.actions.values():
+                    self.store.save_action(changes.step, name, action)
+                for step, entries in changes.fingerprints.items():
+                    self.store.save_fingerprints(step, entries)
+            return True
+        except (OSError, sqlite3.Error) as e:
+            print(f"Ошибка сохранения проекта: {e}")
             return False
 
+    def restore_changes(self, changes):
+        """Снова отмечает изменения, которые не удалось записать, чтобы сохранить их в следующий раз."""
+        if changes.info is not None:
+            self.saved_info = None
+        if changes.step == self.current_step:
+            self.actions.dirty.update(changes.actions)
+        self.dirty_fingerprints.update(changes.fingerprints)
+
+    def save_project(self):
+        """Записывает в базу только изменившиеся данные проекта."""
+        changes = self.collect_changes()
+        if self.write_changes(changes):
+            return True
+        self.restore_changes(changes)
+        return False
+
+    def set_virtual_crops(self, virtual):
+        """Включает сохранение промежуточных этапов описаниями вместо изображений."""
+        self.virtual_crops = virtual
+        if self.store is None:
+            self.save_project()
+        self.store.set_setting('virtual_crops', virtual)
+
+    def set_letter_limits(self, limits):
+        """Задает порог и допустимые размеры букв проекта (segment.LetterLimits)."""
+        self.letter_limits = limits
+        if self.store is None:
+            self.save_project()
+        self.store.set_setting('letter_limits', limits._asdict())
+
+    def relocate(self, work_dir):
+        """Переносит пути проекта в новую папку (проект скопирован на другую машину)."""
+        self.work_dir = work_dir
+        self.load_current_files()
+        self.save_project()
+
     def get_possible_project_name(self):
+        return self.work_dir + '/processing/' + os.path.basename(self.work_dir) + ".db"
+
+    def get_legacy_project_name(self):
         return self.work_dir + '/processing/' + os.path.basename(self.work_dir) + ".blr"
 
     def new_project(self, window):
@@ -146,15 +323,14 @@ class Project:
         if self.work_dir == "":
             return False
         possible_project_name = self.get_possible_project_name()
-        if os.path.isfile(possible_project_name):
+        if os.path.isfile(possible_project_name) or os.path.isfile(self.get_legacy_project_name()):
             reply = QMessageBox.question(None, 'Проект существует',
                                          'В папке имеется проект, загрузить его?',
-                                         QMessageBox.Yes | QMessageBox.No,
-                                         QMessageBox.No)
+                                         QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+                                         QMessageBox.StandardButton.No)
 
-            if reply == QMessageBox.Yes:
-                self.load_project()
-                return True
+            if reply == QMessageBox.StandardButton.Yes:
+                return self.load_project()
         else:
             if self.make_structure():
                 self.file_project_name = possible_project_name
@@ -171,193 +347,490 @@ class Project:
             for step in self.steps:
                 if not os.path.isdir(self.work_dir + '/processing/' + step):
                     os.mkdir(self.work_dir + '/processing/' + step)
+            # Сканы не копируются: в папке этапа создаются ссылки на них через хранилище изображений
+            blobs = self.get_blob_store()
             files = os.listdir(self.work_dir)
             for fname in files:
                 if os.path.isfile(os.path.join(self.work_dir, fname)):
-                    shutil.copy2(os.path.join(self.work_dir, fname), self.work_dir + '/processing/vertical_cut')
+                    blobs.add_file(os.path.join(self.work_dir, fname),
+                                   self.work_dir + '/processing/vertical_cut/' + fname)
             return True
         except OSError:
             return False
 
+    def get_blob_store(self):
+        return BlobStore(self.work_dir + '/processing/blobs')
+
+    def get_next_step_dir(self):
+        return self.work_dir + '/processing/' + self.steps[self.current_step + 1]
+
     def crop_image(self, file, crop_params):
+        return pipeline.crop_image(file, crop_params, self.get_next_step_dir())
+
+    def apply_action(self, file, action):
+        return pipeline.apply_action(file, action, self.get_next_step_dir(), self.virtual_crops)
+
+    def propose_rotations(self, workers=None, progress=None, is_cancelled=None):
         """
-        Обрезает изображение с учетом отрицательной координаты x.
+        Оценивает наклон файлов этапа rotation, у которых еще нет действия, и записывает
+        оценку как действие: уверенное - готовым (final), остальные - для проверки оператором.
 
-        :param file: Имя входного файла изображения
-        :param crop_params: Кортеж (x, y)
+        :return: Индексы файлов, требующих проверки, или None при отмене
         """
-        image_parts = [(0, 0, 1675, 152), (1795, 0, 2155, 152),
-                       (2395, 0, 2875, 152), (2995, 0, 3235, 152),
-                       (120, 185, 1560, 337), (1795, 185, 3235, 337)]
-        for i in range(2, 11):
-            y0 = i * 185
-            image_parts.append((120, y0, 1560, y0 + 152))
-            image_parts.append((1795, y0, 3235, y0 + 152))
-        # Открываем изображение
-        image = Image.open(file)
-        width, height = image.size
-        x, y = crop_params
-        if x < 0:
-            # Создаем новое изображение с увеличенной шириной
-            new_width = width + ceil(abs(x))
-            new_image = Image.new("RGB", (new_width, height), (255, 255, 255))  # Белый фон
-            new_image.paste(image, (ceil(abs(x)), 0))  # Вставляем исходное изображение справа
-            image = new_image
-            x = 0  # Теперь x начинается с 0
-        for i in range(len(image_parts)):
-            p = image_parts[i]
-            output_file = self.work_dir + '/processing/' + self.steps[self.current_step + 1] + \
-                          '/' + os.path.splitext(os.path.basename(file))[0] + 'w' + str(i).zfill(2) + \
-                          os.path.splitext(os.path.basename(file))[1]
-            cropped_image = image.crop((x + p[0], y + p[1], x + p[2], y + p[3]))
-            cropped_image.save(output_file)
+        indices = [i for i in range(len(self.files)) if i not in self.actions]
+        results = self.map_files(deskew.estimate_file, indices, 'оценке наклона',
+                                 workers=workers, progress=progress, is_cancelled=is_cancelled)
+        if results is None:
+            return None
+        review = []
+        actions = dict()
+        for i in sorted(results):
+            if results[i] is None:
+                continue
+            angle, confidence = results[i]
+            final = confidence >= deskew.MIN_CONFIDENCE
+            actions[i] = Action('rotation', value=angle, final=final)
+            if not final:
+                review.append(i)
+        self.actions.update(actions)
+        return review
 
-    def apply_action(self, file, action):
-        if action.type == 'vertical_cut':
-            left_name = self.work_dir + '/processing/' + self.steps[self.current_step + 1] + \
-                        '/' + os.path.splitext(os.path.basename(file))[0] + 'v0' + \
-                        os.path.splitext(os.path.basename(file))[1]
-            right_name = self.work_dir + '/processing/' + self.steps[self.current_step + 1] + \
-                         '/' + os.path.splitext(os.path.basename(file))[0] + 'v1' + \
-                         os.path.splitext(os.path.basename(file))[1]
-            # Открываем исходное изображение
-            image = Image.open(file)
-            width, height = image.size
-            # Координата X для вертикального разреза
-            cut_position = action.value  # Например, разрез посередине
-            # Создаем две новые области для кропа
-            left_half = image.crop((0, 0, cut_position, height))
-            right_half = image.crop((cut_position, 0, width, height))
-            # Сохраняем левую половину
-            left_half.save(left_name)
-            # Сохраняем правую половину
-            right_half.save(right_name)
-        elif action.type == 'horizontal_cut':
-            top_name = self.work_dir + '/processing/' + self.steps[self.current_step + 1] + \
-                       '/' + os.path.splitext(os.path.basename(file))[0] + 'h0' + \
-                       os.path.splitext(os.path.basename(file))[1]
-            bottom_name = self.work_dir + '/processing/' + self.steps[self.current_step + 1] + \
-                          '/' + os.path.splitext(os.path.basename(file))[0] + 'h1' + \
-                          os.path.splitext(os.path.basename(file))[1]
-            # Открываем исходное изображение
-            image = Image.open(file)
-            width, height = image.size
-            # Координата Y для горизонтального разреза
-            cut_position = action.value  # Например, разрез посередине
-            # Создаем две новые области для кропа
-            top_half = image.crop((0, 0, width, cut_position))
-            bottom_half = image.crop((0, cut_position, width, height))
-            # Сохраняем верхнюю половину
-            top_half.save(top_name)
-            # Сохраняем нижнюю половину
-            bottom_half.save(bottom_name)
-        elif action.type == 'orientation':
-            new_name = self.work_dir + '/processing/' + self.steps[self.current_step + 1] + \
-                       '/' + os.path.basename(file)
-            image = Image.open(file).rotate(180)
-            image.save(file)
-            self.angle_adjust(file, new_name)
-        elif action.type == 'rotation':
-            new_name = self.work_dir + '/processing/' + self.steps[self.current_step + 1] + \
-                       '/' + os.path.basename(file)
-            image = Image.open(file).rotate(-action.value)
-            image.save(new_name)
-        elif action.type == 'word_select':
-            self.crop_image(file, action.value)
-
-    def angle_adjust(self, file, new_file):
-        img = cv2.imread(file)
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        edges = cv2.Canny(gray, 50, 150, apertureSize=3)
-        contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        max_area = 0
-        best_rect = None
-        for cnt in contours:
-            area = cv2.contourArea(cnt)
-            if area > max_area:
-                max_area = area
-                best_rect = cv2.minAreaRect(cnt)
-        if best_rect is not None:
-            angle = best_rect[-1]
-            if -10 < angle < 10:
-                image = Image.open(file)
-                rotated_image = image.rotate(angle, expand=True)
-                rotated_image.save(new_file)
-            else:
-                image = Image.open(file)
-                # rotated_image = image.rotate(angle, expand=True)
-                image.save(new_file)
+    def restore_actions(self, step):
+        """Действия этапа из базы, сопоставленные с текущим списком файлов по именам."""
+        if self.store is None:
+            return ActionStore()
+        by_name = self.store.load_actions(step)
+        return ActionStore({i: Action(*by_name[os.path.basename(file)]) for i, file in enumerate(self.files)
+                            if os.path.basename(file) in by_name})
+
+    def file_fingerprint(self, step, file):
+        """Хэш содержимого файла; пересчитывается, только если изменились размер или время изменения."""
+        st = os.stat(file)
+        stat = (st.st_size, st.st_mtime_ns)
+        entry = self.fingerprints.get(step, dict()).get(os.path.basename(file))
+        if entry is not None and entry[0] == stat:
+            return stat, entry[1]
+        # Файл - ссылка на изображение хранилища, хэш которого уже известен
+        blob_id = self.store.image_id(step, os.path.basename(file))
+        if blob_id is not None and self.get_blob_store().contains(file, blob_id):
+            return stat, blob_id
+        return stat, file_digest(file)
+
+    def remove_outputs(self, step, names):
+        """Удаляет файлы этапа step с иконками и всё, что было из них получено на следующих этапах."""
+        files = {(step, name) for name in names}
+        if not files:
+            return
+        # Зависимые файлы находятся по индексу происхождения, без обхода папок
+        files |= self.store.derived_files(step, names)
+        for file_step, name in files:
+            step_dir = self.work_dir + '/processing/' + self.steps[file_step]
+            for path in (step_dir + '/' + name, self.get_thumbnail_name(file_step, name)):
+                if os.path.isfile(path):
+                    os.remove(path)
+            if self.fingerprints.get(file_step, dict()).pop(name, None) is not None:
+                self.dirty_fingerprints.add(file_step)
+        self.store.forget_files(files)
+
+    def get_dependent_files(self, source_name):
+        """Файлы всех этапов, полученные из исходного скана: [(этап, путь, действие)]."""
+        return [(step, self.work_dir + '/processing/' + self.steps[step] + '/' + name, action_key)
+                for step, name, action_key in self.store.dependent_files(source_name)]
+
+    def trace_file(self, file):
+        """
+        Цепочка операций от исходного скана до файла.
 
-    def next_step(self):
+        :return: Путь к исходному скану и список (этап, входной файл, действие, результат);
+            для файла вне папок этапов - (None, [])
+        """
+        step_name = os.path.basename(os.path.dirname(file))
+        if step_name not in self.steps:
+            return None, []
+        step = self.steps.index(step_name)
+        chain = self.store.trace(step, os.path.basename(file))
+        source = self.store.source_path(chain[0][1]) if chain else None
+        return source, chain
+
+    def next_step(self, thumbnails=True, workers=None, progress=None, is_cancelled=None):
+        """
+        Применяет действия текущего этапа к отмеченным файлам и переходит на следующий этап.
+        Повторно обрабатываются только файлы, у которых изменилось содержимое или действие,
+        остальные результаты следующего этапа сохраняются.
+
+        :param thumbnails: Сгенерировать иконки следующего этапа
+        :param workers: Число процессов для обработки файлов (None - по числу ядер)
+        :param progress: Функция progress(обработано, всего, описание)
+        :param is_cancelled: Функция без аргументов; при отмене проект остается на текущем этапе
+        """
+        if self.store is None:
+            self.save_project()
+        step = self.current_step
+        next_dir = self.get_next_step_dir()
+        step_prints = self.fingerprints.setdefault(step, dict())
+        self.dirty_fingerprints.add(step)
+        blobs_dir = self.get_blob_store().root
+        self.errors = []
+        self.review = []
+        tasks = []
+        pending = dict()  # {индекс: (имя, размер и время, хэш, действие)}
+        kept_sources = set()
+        keep = set()
         try:
-            for filename in os.listdir(self.work_dir + '/processing/' + STEPS[self.current_step + 1]):
-                file_path = os.path.join(self.work_dir + '/processing/' + STEPS[self.current_step + 1], filename)
-                os.remove(file_path)
-            if os.path.isdir(self.work_dir + '/processing/' + STEPS[self.current_step + 1] + '/thumbnails'):
-                shutil.rmtree(self.work_dir + '/processing/' + STEPS[self.current_step + 1] + '/thumbnails')
-            if not os.path.isdir(self.work_dir + '/processing/' + STEPS[self.current_step + 1] + '/thumbnails'):
-                os.mkdir(self.work_dir + '/processing/' + STEPS[self.current_step + 1] + '/thumbnails')
-        except OSError:
+            if step in (0, 1, 2, 3, 4):
+                check_list = self.get_current_check_list()
+                files = self.get_current_files()
+                actions = self.get_current_action()
+                for i in range(len(files)):
+                    if not check_list[i]:
+                        continue
+                    name = os.path.basename(files[i])
+                    action = actions.get(i)
+                    action_key = None if action is None else (action.type, action.value)
+                    stat, digest = self.file_fingerprint(step, files[i])
+                    entry = step_prints.get(name)
+                    if (entry is not None and entry[1:3] == (digest, action_key) and
+                            all(os.path.isfile(next_dir + '/' + o) for o in entry[3])):
+                        step_prints[name] = (stat,) + entry[1:]
+                        kept_sources.add(name)
+                        keep.update(entry[3])
+                    else:
+                        tasks.append(pipeline.StepTask(i, step, files[i], action, next_dir, blobs_dir,
+                                                       self.virtual_crops))
+                        pending[i] = (name, stat, digest, action_key)
+            # Результаты измененных, снятых с обработки и удаленных файлов устарели
+            stale = set()
+            for name in list(step_prints):
+                if name not in kept_sources:
+                    stale.update(step_prints.pop(name)[3])
+            for filename in os.listdir(next_dir):
+                if os.path.isfile(os.path.join(next_dir, filename)):
+                    stale.add(filename)
+            self.remove_outputs(step + 1, stale - keep)
+            if stale - keep:
+                self.get_blob_store().collect_garbage()
+                self.get_thumbnail_cache().collect_garbage()
+            if thumbnails and not os.path.isdir(next_dir + '/thumbnails'):
+                os.mkdir(next_dir + '/thumbnails')
+        except (OSError, sqlite3.Error):
             return False
-        if self.current_step in (0, 1, 2, 3, 4):
-            check_list = self.get_current_check_list()
-            files = self.get_current_files()
-            actions = self.get_current_action()
-            for i in range(len(files)):
-                if check_list[i]:
-                    if i in self.actions:
-                        self.apply_action(files[i], actions[i])
+        if step == 0:
+            self.store.add_sources(self.work_dir + '/' + os.path.basename(f) for f in self.files)
+        if tasks:
+            # Каждый файл обрабатывается независимо, поэтому задачи раздаются пулу процессов
+            file_progress = None
+            if progress is not None:
+                def file_progress(done, total):
+                    progress(done, total, 'обработка файлов')
+            results = pipeline.run_tasks(tasks, workers, file_progress, is_cancelled)
+            if results is None:
+                return False
+            with self.store.transaction():
+                for i in sorted(results):
+                    result, error = results[i]
+                    name, stat, digest, action_key = pending[i]
+                    if error is not None:
+                        self.errors.append((self.files[i], error))
+                        print(f'Ошибка при обработке {self.files[i]}: {error}')
                     else:
-                        file = self.files[i]
-                        new_file = self.work_dir + '/processing/' + self.steps[self.current_step + 1] + \
-                                   '/' + os.path.basename(file)
-                        if self.current_step in (0, 1):
-                            try:
-                                shutil.copy2(file, new_file)
-                            except OSError:
-                                return False
-                        elif self.current_step == 2:
-                            self.angle_adjust(file, new_file)
-
-        self.actions = dict()
-        self.check_list = None
+                        outputs, blob_ids = result
+                        outputs = [os.path.basename(o) for o in outputs]
+                        step_prints[name] = (stat, digest, action_key, outputs)
+                        self.store.record_results(step, name, action_key, outputs, blob_ids)
+        if thumbnails:
+            # Иконки создаются до смены этапа, чтобы отмена не оставила проект в промежуточном состоянии
+            thumbnail_progress = None
+            if progress is not None:
+                def thumbnail_progress(done, total):
+                    progress(done, total, 'создание иконок')
+            if self.update_thumbnails(step + 1, thumbnail_progress, is_cancelled, workers) is None:
+                return False
+
+        self.save_project()
         self.current_step += 1
         self.load_current_files()
-        self.generate_thumbnails()
+        self.actions = self.restore_actions(self.current_step)
+        self.check_list = None
+        if STEPS[self.current_step] == 'rotation':
+            deskew_progress = None
+            if progress is not None:
+                def deskew_progress(done, total):
+                    progress(done, total, 'оценка наклона')
+            self.review = self.propose_rotations(workers, deskew_progress, is_cancelled) or []
         self.save_project()
         return self.current_step
 
+    def previous_step(self):
+        """Возвращает проект на предыдущий этап; результаты текущего этапа сохраняются."""
+        if self.current_step == 0:
+            return False
+        self.save_project()
+        self.current_step -= 1
+        self.load_current_files()
+        self.actions = self.restore_actions(self.current_step)
+        self.check_list = None
+        self.review = []
+        self.save_project()
+        return True
+
     def load_current_files(self):
         if self.work_dir is None:
             return ''
         else:
             current_step_dir = self.work_dir + '/processing/' + self.steps[self.current_step]
-            files = [os.path.join(current_step_dir, f) for f in os.listdir(current_step_dir) if
-                     os.path.isfile(os.path.join(current_step_dir, f))]
+            # Порядок файлов определяет индексы действий, поэтому он не должен зависеть от ФС
+            files = sorted(os.path.join(current_step_dir, f) for f in os.listdir(current_step_dir) if
+                           os.path.isfile(os.path.join(current_step_dir, f)))
             self.files = files
             return files
 
-    def generate_thumbnails(self):
-        thumbnails = []
-        for file in self.load_current_files():
-            image = Image.open(file)
-            image.thumbnail((400, 400))
-            new_name = self.work_dir + '/processing/' + self.steps[self.current_step] + \
-                       '/thumbnails/' + os.path.splitext(os.path.basename(file))[0] + '.jpg'
-            image = image.convert('RGB')
-            image.save(new_name, format='JPEG')
-            thumbnails.append(new_name)
-        return thumbnails
+    def get_step_files(self, step):
+        if step == self.current_step:
+            return self.load_current_files()
+        step_dir = self.work_dir + '/processing/' + self.steps[step]
+        return sorted(os.path.join(step_dir, f) for f in os.listdir(step_dir) if
+                      os.path.isfile(os.path.join(step_dir, f)))
+
+    def get_thumbnail_name(self, step, file):
+        return self.work_dir + '/processing/' + self.steps[step] + \
+            '/thumbnails/' + vimage.split_name(file)[0] + '.jpg'
+
+    def get_thumbnail_cache(self):
+        return BlobStore(self.work_dir + '/processing/thumbcache')
+
+    def clean_thumbnail(self, file):
+        """Иконка файла текущего этапа без пометок действий из общего кэша иконок или None."""
+        if self.store is None:
+            return None
+        try:
+            digest = self.file_fingerprint(self.current_step, file)[1]
+        except (OSError, sqlite3.Error):
+            return None
+        path = thumbnails.cache_name(self.get_thumbnail_cache().root, thumbnails.cache_key(digest))
+        return path if os.path.isfile(path) else None
+
+    def generate_thumbnails(self, step=None, progress=None, is_cancelled=None, files=None,
+                            workers=None, keys=None):
+        """
+        Создает иконки файлов этапа step (по умолчанию текущего). Иконка берется из кэша
+        по хэшу файла, недостающие иконки создаются в пуле процессов.
+
+        :param files: Файлы этапа, для которых нужны иконки (по умолчанию все)
+        :param workers: Число процессов (None - по числу ядер)
+        :param keys: Уже вычисленные ключи кэша {имя файла: ключ}
+        :return: Список созданных иконок или None, если генерация была отменена
+        """
+        if step is None:
+            step = self.current_step
+        if files is None:
+            files = self.get_step_files(step)
+        if keys is None:
+            keys = dict()
+        cache_dir = self.get_thumbnail_cache().root
+        created = dict()
+        tasks = []
+        for i, file in enumerate(files):
+            name = os.path.basename(file)
+            key = keys.get(name) or thumbnails.cache_key(self.file_fingerprint(step, file)[1])
+            task = thumbnails.ThumbnailTask(i, file, thumbnails.cache_name(cache_dir, key),
+                                            self.get_thumbnail_name(step, file))
+            if os.path.isfile(task.cache_file):
+                # Иконка такого же изображения уже есть - достаточно ссылки
+                link_file(task.cache_file, task.dest)
+                created[i] = task.dest
+            else:
+                tasks.append(task)
+        if tasks:
+            results = pipeline.run_tasks(tasks, workers, progress, is_cancelled,
+                                         func=thumbnails.run_thumbnail_task)
+            if results is None:
+                return None
+            for i, (dest, error) in results.items():
+                if error is not None:
+                    print(f'Ошибка при создании иконки {files[i]}: {error}')
+                else:
+                    created[i] = dest
+        return [created[i] for i in sorted(created)]
+
+    def update_thumbnails(self, step, progress=None, is_cancelled=None, workers=None):
+        """
+        Удаляет лишние иконки этапа и создает недостающие и устаревшие: иконка устарела,
+        если хэш файла не совпадает с тем, для которого она создана.
+
+        :return: Иконки в порядке файлов этапа или None, если генерация была отменена
+        """
+        thumb_dir = self.work_dir + '/processing/' + self.steps[step] + '/thumbnails'
+        if not os.path.isdir(thumb_dir):
+            os.mkdir(thumb_dir)
+        if self.store is None:
+            self.save_project()
+        files = self.get_step_files(step)
+        thumbnail_names = [self.get_thumbnail_name(step, f) for f in files]
+        expected = set(os.path.basename(t) for t in thumbnail_names)
+        for filename in os.listdir(thumb_dir):
+            if filename not in expected:
+                os.remove(os.path.join(thumb_dir, filename))
+        known = self.store.load_thumbnail_keys(step)
+        entries = dict()
+        stale = []
+        for file, thumbnail in zip(files, thumbnail_names):
+            name = os.path.basename(file)
+            st = os.stat(file)
+            stat = (st.st_size, st.st_mtime_ns)
+            entry = known.get(name)
+            if entry is not None and entry[0] == stat:
+                key = entry[1]
+            else:
+                key = thumbnails.cache_key(self.file_fingerprint(step, file)[1])
+            entries[name] = (stat, key)
+            if entry is None or entry[1] != key or not os.path.isfile(thumbnail):
+                stale.append(file)
+        created = self.generate_thumbnails(step, progress, is_cancelled, stale, workers,
+                                           {name: entry[1] for name, entry in entries.items()})
+        if created is None:
+            return None
+        # Иконки, которые не удалось создать, будут созданы заново при следующей загрузке
+        created = set(created)
+        for file in stale:
+            if self.get_thumbnail_name(step, file) not in created:
+                entries.pop(os.path.basename(file))
+        self.store.save_thumbnail_keys(step, entries)
+        return thumbnail_names
 
     def get_current_thumbnails(self):
-        if os.path.isdir(self.work_dir + '/processing/' + self.steps[self.current_step] + '/thumbnails'):
-            td = self.work_dir + '/processing/' + self.steps[self.current_step] + '/thumbnails'
-            thumbnails = [os.path.join(td, f) for f in os.listdir(td) if
-                          os.path.isfile(os.path.join(td, f))]
-            return thumbnails
-        else:
-            os.mkdir(self.work_dir + '/processing/' + self.steps[self.current_step] + '/thumbnails')
-            return self.generate_thumbnails()
+        names = self.update_thumbnails(self.current_step)
+        self.load_image_sizes()
+        return names
+
+    def load_image_sizes(self):
+        """Индекс размеров файлов текущего этапа; читаются только заголовки файлов."""
+        self.image_sizes = [imagecache.image_size(f) for f in self.files]
+        return self.image_sizes
+
+    def map_files(self, func, indices, description, *args, workers=None, progress=None, is_cancelled=None):
+        """
+        Вызывает func(файл, *args) для файлов этапа indices в пуле процессов (см. pipeline.map_files).
+        Ошибки выводятся с описанием операции description.
+
+        :return: Словарь {индекс: результат или None при ошибке}; None при отмене
+        """
+        results = pipeline.map_files(func, {i: self.files[i] for i in indices}, *args,
+                                     workers=workers, progress=progress, is_cancelled=is_cancelled)
+        if results is None:
+            return None
+        for i, (_, error) in sorted(results.items()):
+            if error is not None:
+                print(f'Ошибка при {description} {self.files[i]}: {error}')
+        return {i: result for i, (result, _) in results.items()}
+
+    def unconfirmed_indices(self):
+        """Индексы файлов этапа без подтвержденного действия (их можно разметить автоматически)."""
+        confirmed = set(self.actions.indices(final=True).tolist())
+        return [i for i in range(len(self.files)) if i not in confirmed]
+
+    def add_default_cuts(self, indices=None):
+        """
+        Добавляет разрез посередине файлов indices (по умолчанию всех файлов этапа)
+        одним обновлением действий.
+
+        :return: Индексы файлов, получивших разрез
+        """
+        cut_type = self.steps[self.current_step]
+        if cut_type not in ('vertical_cut', 'horizontal_cut'):
+            return []
+        if len(self.image_sizes) != len(self.files):
+            self.load_image_sizes()
+        if indices is None:
+            indices = range(len(self.files))
+        actions = dict()
+        for i in indices:
+            width, height = self.image_sizes[i]
+            value = width // 2 if cut_type == 'vertical_cut' else height // 2
+            actions[i] = Action(cut_type, value=value, final=False)
+        self.actions.update(actions)
+        return list(actions)
+
+    def detect_cuts(self, indices=None, workers=None, progress=None, is_cancelled=None):
+        """
+        Ищет разрез в файлах indices (по умолчанию во всех файлах этапа без подтвержденного
+        действия) и записывает его неподтвержденным действием. Если разрез не найден уверенно, предлагается разрез посередине.
+
+        :return: Индексы файлов с неуверенной оценкой или None при отмене
+        """
+        cut_type = self.steps[self.current_step]
+        if cut_type not in ('vertical_cut', 'horizontal_cut'):
+            return []
+        if indices is None:
+            indices = self.unconfirmed_indices()
+        results = self.map_files(cutdetect.detect_cut, indices, 'поиске разреза', cut_type,
+                                 workers=workers, progress=progress, is_cancelled=is_cancelled)
+        if results is None:
+            return None
+        review = []
+        actions = dict()
+        for i in sorted(results):
+            estimate = results[i]
+            if estimate is None or estimate[1] < cutdetect.MIN_CONFIDENCE:
+                review.append(i)
+            else:
+                actions[i] = Action(cut_type, value=estimate[0], final=False)
+        self.actions.update(actions)
+        self.add_default_cuts(review)
+        return review
+
+    def register_grids(self, indices=None, workers=None, progress=None, is_cancelled=None):
+        """
+        Находит сетку слов по меткам бланка в файлах indices (по умолчанию во всех файлах этапа
+        без подтвержденного действия) и записывает ее положение действием word_select:
+        уверенное - готовым (final), остальные - для проверки оператором.
+
+        :return: Индексы файлов с неуверенной оценкой или None при отмене
+        """
+        if self.steps[self.current_step] != 'word_select':
+            return []
+        if indices is None:
+            indices = self.unconfirmed_indices()
+        results = self.map_files(gridreg.register_file, indices, 'поиске сетки',
+                                 workers=workers, progress=progress, is_cancelled=is_cancelled)
+        if results is None:
+            return None
+        review = []
+        actions = dict()
+        for i in sorted(results):
+            result = results[i]
+            origin = (0.0, 0.0) if result is None else result[0]
+            final = result is not None and result[3] >= gridreg.MIN_CONFIDENCE
+            actions[i] = Action('word_select', value=origin, final=final)
+            if not final:
+                review.append(i)
+        self.actions.update(actions)
+        return review
+
+    def segment_letters(self, indices=None, workers=None, progress=None, is_cancelled=None):
+        """
+        Выделяет буквы в файлах indices (по умолчанию во всех файлах этапа без подтвержденного
+        действия) и записывает прямоугольники неподтвержденными действиями letter_select.
+
+        :return: Индексы файлов, где буквы не найдены, или None при отмене
+        """
+        if self.steps[self.current_step] != 'letter_select':
+            return []
+        if indices is None:
+            indices = self.unconfirmed_indices()
+        results = self.map_files(segment.segment_file, indices, 'выделении букв', self.letter_limits,
+                                 workers=workers, progress=progress, is_cancelled=is_cancelled)
+        if results is None:
+            return None
+        review = []
+        actions = dict()
+        for i in sorted(results):
+            rectangles = results[i]
+            if not rectangles:
+                review.append(i)
+            if rectangles is not None:
+                actions[i] = Action('letter_select', value=rectangles, final=False)
+        self.actions.update(actions)
+        return review
 
 
 class ImageViewer(QGraphicsView):
@@ -366,34 +839,47 @@ class ImageViewer(QGraphicsView):
                  on_action_removed: Callable[[int], None],
                  current_step,
                  current_action=None,
-                 container_size=(2000, 1000)):
+                 container_size=(2000, 1000),
+                 letter_limits=segment.DEFAULT_LIMITS):
         super().__init__()
         self.setMouseTracking(True)
+        self.on_action_added = on_action_added
+        self.on_action_removed = on_action_removed
+        self.letter_limits = letter_limits
+        self.scene = QGraphicsScene(self)
+        self.setScene(self.scene)
+        self.set_image(image_path, image_index, current_step, current_action, container_size)
+
+    def set_image(self, image_path, image_index, current_step, current_action=None, container_size=None):
+        """
+        Показывает другой файл в том же окне: сцена очищается, создаются только
+        изображение и элементы действия. Без container_size сохраняется прежний размер.
+        """
+        self.scene.clear()
         self.borders = None
+        self.border_index = None  # RectIndex прямоугольников букв
+        self.highlighted = None  # индекс подсвеченного прямоугольника
         self.angle = None
         self.rotation_line = None
         self.rotation_handle = None
         self.current_step = current_step
         self.image_index = image_index
-        self.on_action_added = on_action_added
-        self.on_action_removed = on_action_removed
-        self.scene = QGraphicsScene(self)
-        self.setScene(self.scene)
         self.image_path = image_path
-        self.pixmap = QPixmap(image_path)
+        # Пирамида уровней: декодируется только уровень, нужный для размера окна,
+        # и только видимые плитки; пирамиды недавних файлов переиспользуются
+        self.pyramid = get_pyramid(image_path)
         self.pos_in_original_image = None
         self.right_btn = False
-        original_width = self.pixmap.width()
-        original_height = self.pixmap.height()
+        original_width, original_height = self.pyramid.size
         # Масштабирование изображения
-        self.container_width, self.container_height = container_size
-        scaled_pixmap = self.pixmap.scaled(self.container_width, self.container_height,
-                                           transformMode=Qt.TransformationMode.SmoothTransformation,
-                                           aspectRatioMode=Qt.AspectRatioMode.KeepAspectRatio)
-        self.pixmap_item = QGraphicsPixmapItem(scaled_pixmap)
+        if container_size is not None:
+            self.container_width, self.container_height = container_size
+        display_size = fit_size(self.pyramid.size, (self.container_width, self.container_height))
+        self.pixmap_item = TiledImageItem(self.pyramid, display_size)
         self.scene.addItem(self.pixmap_item)
-        self.scale_x = original_width / scaled_pixmap.width()
-        self.scale_y = original_height / scaled_pixmap.height()
+        self.scene.setSceneRect(self.pixmap_item.boundingRect())
+        self.scale_x = original_width / display_size.width()
+        self.scale_y = original_height / display_size.height()
         self.mouse_press_pos = None
         self.line = None
         self.grid = None
@@ -403,6 +889,12 @@ class ImageViewer(QGraphicsView):
         else:
             self.current_line = None
 
+    def refit(self, container_size):
+        """Вписывает изображение в новый размер окна; элементы действия перестраиваются."""
+        if container_size == (self.container_width, self.container_height):
+            return
+        self.set_image(self.image_path, self.image_index, self.current_step, self.current_action, container_size)
+
     def apply_action(self):
         if self.current_action.final:
             color = Qt.GlobalColor.green
@@ -410,42 +902,27 @@ class ImageViewer(QGraphicsView):
             color = Qt.GlobalColor.red
         if self.current_action.type == 'vertical_cut':
             x = self.current_action.value / self.scale_x
-            self.line = QGraphicsLineItem(x, 0, x, self.pixmap_item.pixmap().height())
+            self.line = QGraphicsLineItem(x, 0, x, self.pixmap_item.height())
             self.line.setPen(color)
             self.scene.addItem(self.line)
         elif self.current_action.type == 'horizontal_cut':
             y = self.current_action.value / self.scale_y
-            self.line = QGraphicsLineItem(0, y, self.pixmap_item.pixmap().width(), y)
+            self.line = QGraphicsLineItem(0, y, self.pixmap_item.width(), y)
             self.line.setPen(color)
             self.scene.addItem(self.line)
         elif self.current_action.type == 'orientation':
-            image = Image.open(self.image_path)
-            # Поворачиваем изображение на 180 градусов
-            rotated_image = image.rotate(180, expand=True)
-            self.scene.removeItem(self.pixmap_item)
-            self.pixmap = pil2pixmap(rotated_image)
-            scaled_pixmap = self.pixmap.scaled(self.container_width, self.container_height,
-                                               transformMode=Qt.TransformationMode.SmoothTransformation,
-                                               aspectRatioMode=Qt.AspectRatioMode.KeepAspectRatio)
-            self.pixmap_item = QGraphicsPixmapItem(scaled_pixmap)
-            self.scene.addItem(self.pixmap_item)
+            self.set_preview_rotation(self.current_action.value)
         elif self.current_action.type == 'rotation':
-            image = Image.open(self.image_path)
-            rotated_image = image.rotate(-self.current_action.value, expand=True)
-            self.scene.removeItem(self.pixmap_item)
-            self.pixmap = pil2pixmap(rotated_image)
-            scaled_pixmap = self.pixmap.scaled(self.container_width, self.container_height,
-                                               transformMode=Qt.TransformationMode.SmoothTransformation,
-                                               aspectRatioMode=Qt.AspectRatioMode.KeepAspectRatio)
-            self.pixmap_item = QGraphicsPixmapItem(scaled_pixmap)
-            self.scene.addItem(self.pixmap_item)
+            self.angle = self.current_action.value
+            self.set_preview_rotation(self.angle)
         elif self.current_action.type == 'word_select':
             x = self.current_action.value[0] / self.scale_x
             y = self.current_action.value[1] / self.scale_y
-            w = GRID_WIDTH / self.scale_x
-            h = GRID_HEIGHT / self.scale_y
+            w = layout.GRID_WIDTH / self.scale_x
+            h = layout.GRID_HEIGHT / self.scale_y
             self.grid = QGraphicsRectItem()
-            self.grid.setRect(QRectF(x, y, w, h))
+            self.grid.setRect(QRectF(0, 0, w, h))
+            self.grid.setPos(x, y)
             self.grid.setPen(Qt.GlobalColor.red)
             self.scene.addItem(self.grid)
         elif self.current_action.type == 'letter_select':
@@ -461,6 +938,23 @@ class ImageViewer(QGraphicsView):
                 rect.setPen(color)
                 self.borders.append(rect)
                 self.scene.addItem(rect)
+            self.border_index = RectIndex(rect.rect() for rect in self.borders)
+            self.highlighted = None
+
+    def set_preview_rotation(self, angle):
+        """
+        Поворачивает изображение в окне на angle градусов по часовой стрелке (как rotate(-angle) в PIL).
+        Поворот выполняется преобразованием элемента сцены, пиксели не пересчитываются:
+        изображение вращается вокруг центра и уменьшается так, чтобы целиком поместиться в окне.
+        """
+        item = self.pixmap_item
+        item.setTransformOriginPoint(item.boundingRect().center())
+        item.setScale(1)
+        item.setRotation(angle)
+        bounds = item.sceneBoundingRect()
+        scale = min(self.container_width / bounds.width(), self.container_height / bounds.height(), 1)
+        item.setScale(scale)
+        self.scene.setSceneRect(item.sceneBoundingRect())
 
     def contour(self):
         rectangles = self.contouring(self.image_path)
@@ -469,21 +963,7 @@ class ImageViewer(QGraphicsView):
         self.add_action()
 
     def contouring(self, file):
-        img = cv2.imread(file)
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        _, thresh = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY_INV)
-        kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
-        thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
-        contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        min_width, max_width = 50, 100  # Ширина в пределах 110–130 пикселей
-        min_height, max_height = 60, 170  # Высота в пределах 170–200 пикселей
-        rectangles = []
-        for cnt in contours:
-            x, y, w, h = cv2.boundingRect(cnt)
-            if (min_width <= w <= max_width and
-                    min_height <= h <= max_height):
-                rectangles.append((x, y, w, h))  # Добавляем координаты прямоугольника в список
-        return tuple(rectangles)
+        return segment.segment_file(file, self.letter_limits)
 
     def add_action(self):
         if self.on_action_added:
@@ -502,52 +982,44 @@ class ImageViewer(QGraphicsView):
 
     def flip(self):
         if self.current_step == 2:  # Переворот
-            # Открываем изображение
-            image = Image.open(self.image_path)
-            # Поворачиваем изображение на 180 градусов
-            rotated_image = image.rotate(180, expand=True)
-            self.scene.removeItem(self.pixmap_item)
-            self.pixmap = pil2pixmap(rotated_image)
-            scaled_pixmap = self.pixmap.scaled(self.container_width, self.container_height,
-                                               transformMode=Qt.TransformationMode.SmoothTransformation,
-                                               aspectRatioMode=Qt.AspectRatioMode.KeepAspectRatio)
-            self.pixmap_item = QGraphicsPixmapItem(scaled_pixmap)
-            self.scene.addItem(self.pixmap_item)
+            self.set_preview_rotation(180)
             self.current_action = Action(type='orientation', value=180, final=True)
             self.add_action()
 
     def add_line(self):
         if self.line is not None:
             return
+        if self.current_step not in (0, 1):
+            return
+        # Линия ставится туда, где найден сгиб или поле между страницами
+        cut_type = STEPS[self.current_step]
+        try:
+            value, _ = cutdetect.detect_cut(self.image_path, cut_type)
+        except (OSError, ValueError) as e:
+            print(f'Ошибка при поиске разреза {self.image_path}: {e}')
+            # Разрез посередине изображения
+            if self.current_step == 0:
+                value = int(self.pixmap_item.width() // 2 * self.scale_x)
+            else:
+                value = int(self.pixmap_item.height() // 2 * self.scale_y)
         if self.current_step == 0:  # Вертикальный разрез
-            self.line = QGraphicsLineItem(self.pixmap_item.pixmap().width() // 2, 0,
-                                          self.pixmap_item.pixmap().width() // 2, self.pixmap_item.pixmap().height())
-            self.line.setPen(Qt.GlobalColor.red)
-            self.scene.addItem(self.line)
-            pos_in_original_image = QPointF(
-                self.pixmap_item.pixmap().width() // 2 * self.scale_x,
-                0
-            )
-            self.current_action = Action(type='vertical_cut', value=int(pos_in_original_image.x()), final=False)
-            self.add_action()
-        elif self.current_step == 1:  # Горизонтальный разрез
-            self.line = QGraphicsLineItem(0, self.pixmap_item.pixmap().height() // 2,
-                                          self.pixmap_item.pixmap().width(), self.pixmap_item.pixmap().height() // 2)
-            self.line.setPen(Qt.GlobalColor.red)
-            self.scene.addItem(self.line)
-            pos_in_original_image = QPointF(
-                0, self.pixmap_item.pixmap().height() // 2 * self.scale_y
-            )
-            self.current_action = Action(type='horizontal_cut', value=int(pos_in_original_image.y()), final=False)
-            self.add_action()
+            x = value / self.scale_x
+            self.line = QGraphicsLineItem(x, 0, x, self.pixmap_item.height())
+        else:  # Горизонтальный разрез
+            y = value / self.scale_y
+            self.line = QGraphicsLineItem(0, y, self.pixmap_item.width(), y)
+        self.line.setPen(Qt.GlobalColor.red)
+        self.scene.addItem(self.line)
+        self.current_action = Action(type=cut_type, value=value, final=False)
+        self.add_action()
 
     def rotate(self):
         if self.rotation_line is not None:
             return
         self.angle = 0
-        self.rotation_line = QGraphicsLineItem(0, self.pixmap_item.pixmap().height() // 2,
-                                               self.pixmap_item.pixmap().width(),
-                                               self.pixmap_item.pixmap().height() // 2)
+        self.rotation_line = QGraphicsLineItem(0, self.pixmap_item.height() // 2,
+                                               self.pixmap_item.width(),
+                                               self.pixmap_item.height() // 2)
         self.rotation_line.setPen(Qt.GlobalColor.red)
         self.scene.addItem(self.rotation_line)
         self.current_action = Action(type='rotate', value=0, final=False)
@@ -556,17 +1028,24 @@ class ImageViewer(QGraphicsView):
     def add_grid(self):
         if self.grid is not None:
             return
-        x = 0
-        y = 0
-        w = GRID_WIDTH / self.scale_x
-        h = GRID_HEIGHT / self.scale_y
+        # Сетка ставится по меткам бланка, если они найдены
+        try:
+            result = gridreg.register_file(self.image_path)
+        except (OSError, ValueError, cv2.error) as e:
+            print(f'Ошибка при поиске сетки {self.image_path}: {e}')
+            result = None
+        origin = (0.0, 0.0) if result is None else result[0]
+        x = origin[0] / self.scale_x
+        y = origin[1] / self.scale_y
+        w = layout.GRID_WIDTH / self.scale_x
+        h = layout.GRID_HEIGHT / self.scale_y
+        # Положение сетки хранится в pos(), его же меняет перетаскивание
         self.grid = QGraphicsRectItem()
-        self.grid.setRect(QRectF(x, y, w, h))
+        self.grid.setRect(QRectF(0, 0, w, h))
+        self.grid.setPos(x, y)
         self.grid.setPen(Qt.GlobalColor.red)
         self.scene.addItem(self.grid)
-        self.current_action = Action(type='word_select',
-                                     value=(x * self.scale_x, y * self.scale_y),
-                                     final=False)
+        self.current_action = Action(type='word_select', value=origin, final=False)
         self.add_action()
 
     def add_final_line(self):
@@ -574,7 +1053,7 @@ class ImageViewer(QGraphicsView):
             self.scene.removeItem(self.line)
             if self.current_action.type == 'vertical_cut':
                 x = self.current_action.value / self.scale_x
-                self.line = QGraphicsLineItem(x, 0, x, self.pixmap_item.pixmap().height())
+                self.line = QGraphicsLineItem(x, 0, x, self.pixmap_item.height())
                 self.line.setPen(Qt.GlobalColor.green)
                 self.scene.addItem(self.line)
                 self.current_action = Action(type=self.current_action.type,
@@ -582,7 +1061,7 @@ class ImageViewer(QGraphicsView):
                                              final=True)
             elif self.current_action.type == 'horizontal_cut':
                 y = self.current_action.value / self.scale_y
-                self.line = QGraphicsLineItem(0, y, self.pixmap_item.pixmap().width(), y)
+                self.line = QGraphicsLineItem(0, y, self.pixmap_item.width(), y)
                 self.line.setPen(Qt.GlobalColor.green)
                 self.scene.addItem(self.line)
                 self.current_action = Action(type=self.current_action.type,
@@ -639,21 +1118,22 @@ class ImageViewer(QGraphicsView):
             delta = QPointF(event.pos()) - self.mouse_press_pos
             if not self.right_btn:
                 self.angle += delta.x() * DELTA_ANGLE
-                self.pixmap_item.setRotation(self.angle)
+                self.set_preview_rotation(self.angle)
             else:
                 new_pos = self.rotation_line.pos()
                 delta.setX(0)
                 new_pos += delta
                 self.rotation_line.setPos(new_pos)
             self.mouse_press_pos = QPointF(event.pos())
-        elif self.current_step == 5:
-            pos = QPointF(event.scenePosition())
-            for i, rect in enumerate(self.borders):
-                if rect.contains(pos):
-                    rect.setPen(QPen(Qt.GlobalColor.yellow, 3))
-                    for j, other_rect in enumerate(self.borders):
-                        if j != i:
-                            other_rect.setPen(QPen(Qt.GlobalColor.red, 1))
+        elif self.current_step == 5 and self.border_index is not None:
+            # Меняются только прямоугольник под курсором и ранее подсвеченный
+            hit = self.border_index.find(self.mapToScene(event.position().toPoint()))
+            if hit is None or hit == self.highlighted:
+                return
+            if self.highlighted is not None:
+                self.borders[self.highlighted].setPen(QPen(Qt.GlobalColor.red, 1))
+            self.borders[hit].setPen(QPen(Qt.GlobalColor.yellow, 3))
+            self.highlighted = hit
 
     def mouseReleaseEvent(self, event):
         if self.current_action is None:
@@ -666,7 +1146,7 @@ class ImageViewer(QGraphicsView):
             item_pos = self.itemAt(scene_pos)
             self.current_action = None
             if self.current_step == 0:  # Вертикальный разрез
-                if isinstance(item_pos, QGraphicsPixmapItem):
+                if isinstance(item_pos, TiledImageItem):
                     pixmap_pos = item_pos.mapFromScene(QPointF(scene_pos))
                     pos_in_original_image = QPointF(pixmap_pos.x() * self.scale_x,
                                                     pixmap_pos.y() * self.scale_y)
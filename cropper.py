@@ -11,7 +11,7 @@ import os
 # 0) vertical_cut (к именам файлов добавим vN(0, 1))
 # 1) horizontal_cut (к именам файлов добавим hN(0, 1))
 # 2) orientation(некоторые нужно повернуть на 180)
-#  3) angle_adjust выполняется после шага 2 автоматически + ручная корректировка по необходимости
+#  3) rotation: наклон оценивается автоматически (deskew), сомнительные листы проверяются вручную
 # 4) word_select (к именам файлов добавим wN(00, 01, 02, ...))
 # 5) letter_select(к именам файлов добавим lN(00, 01, 02, ...))
 # 6) Формирование папки output в которой вырезанные буквы и цифры разложены по папкам 0 1 2 3 а б в ...
@@ -28,12 +28,23 @@ import traceback
 
 from PyQt6 import QtGui, QtCore
 from PyQt6.QtWidgets import QGraphicsItem, QLabel, QGroupBox, QVBoxLayout, QGraphicsPixmapItem, QMainWindow
-from PyQt6.QtWidgets import QApplication, QFileDialog, QMessageBox
+from PyQt6.QtWidgets import QApplication, QFileDialog, QMessageBox, QProgressBar, QPushButton
+from PyQt6.QtGui import QShortcut
 from PIL import ImageFont, ImageDraw
 
 from cropper_ui import Ui_MainWindow
 from classes import *
 from functions import *
+from workers import AutoSaver, ProposalWorker, StepWorker
+from thumbview import ThumbnailView
+import imagecache
+import pipeline
+import pyramid
+import thumbnails
+import vimage
+
+
+READ_AHEAD = 3  # сколько следующих файлов декодируется заранее
 
 
 class MyWidget(QMainWindow, Ui_MainWindow):
@@ -49,9 +60,7 @@ class MyWidget(QMainWindow, Ui_MainWindow):
         self.source_dir = None
         self.files = []
         self.thumbnails = []
-        self.labels = []
         self.current_image_index = None
-        self.check_list = []
         self.buttons = {
             "new_project": self.new_project_btn,
             "open": self.open_btn,
@@ -95,6 +104,7 @@ class MyWidget(QMainWindow, Ui_MainWindow):
         self.save_btn.clicked.connect(self.save_project)
         self.check_all_btn.clicked.connect(self.check_all)
         self.next_btn.clicked.connect(self.next_step)
+        self.previous_btn.clicked.connect(self.previous_step)
         self.add_vertical_cut_btn.clicked.connect(self.add_vertical)
         self.add_horizontal_cut_btn.clicked.connect(self.add_horizontal)
         self.new_project_btn.clicked.connect(self.create_new_project)
@@ -102,23 +112,75 @@ class MyWidget(QMainWindow, Ui_MainWindow):
         self.rotate_btn.clicked.connect(self.rotate)
         self.confirm_btn.clicked.connect(self.confirm)
         self.add_grid_btn.clicked.connect(self.add_grid)
-        self.resized.connect(self.thumbnail_click)
+        # Окно просмотра перестраивается один раз после окончания изменения размера
+        self.resize_timer = QtCore.QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(150)
+        self.resize_timer.timeout.connect(self.refit_viewer)
+        self.resized.connect(self.resize_timer.start)
         self.delete_cut_btn.clicked.connect(self.delete_cut)
         self.contour_btn.clicked.connect(self.contour)
         self.source_lb.setText('')
         self.source_lb.setGeometry(0, 0, 1000, 1000)
         self.source_lb.mousePressEvent = self.mousePressEvent
+        # Список иконок строится моделью: виджеты на каждую иконку не создаются
+        self.thumbnail_view = ThumbnailView()
+        self.thumbnail_model = self.thumbnail_view.model()
+        self.thumbnail_view.selectionModel().currentChanged.connect(self.thumbnail_selected)
+        self.thumbnails_sa.setWidget(self.thumbnail_view)
         self.image_viewer = None
         self.scene = None
         self.pixmap = None
         self.project = None
+        self.step_worker = None
+        self.proposal_worker = None
+        self.autosaver = AutoSaver(parent=self)  # изменения записываются в фоне
+        self.progress_bar = QProgressBar()
+        self.progress_bar.hide()
+        self.cancel_step_btn = QPushButton('Отмена')
+        self.cancel_step_btn.hide()
+        self.cancel_step_btn.clicked.connect(self.cancel_step)
+        self.statusbar.addPermanentWidget(self.progress_bar)
+        self.statusbar.addPermanentWidget(self.cancel_step_btn)
+        # Режим проверки: переход только по файлам без подтвержденного действия
+        self.review_btn = QPushButton('Проверка')
+        self.review_btn.setCheckable(True)
+        self.review_btn.setToolTip('Пробел - следующий файл, Backspace - предыдущий, '
+                                   'Enter - подтвердить, F - перевернуть, Ctrl+R - режим проверки')
+        self.statusbar.addPermanentWidget(self.review_btn)
+        self.setup_shortcuts()
         self.show_buttons()
 
+    def setup_shortcuts(self):
+        # Клавиши действуют только в окне просмотра и списке иконок, чтобы не отнимать
+        # пробел и Enter у кнопок и полей; пробел в списке по-прежнему ставит отметку
+        keys = [(('Space', 'PgDown'), self.show_next, (self.image_sa,)),
+                (('Backspace', 'PgUp'), self.show_previous, (self.image_sa,)),
+                (('PgDown',), self.show_next, (self.thumbnail_view,)),
+                (('PgUp',), self.show_previous, (self.thumbnail_view,)),
+                (('Return', 'Enter'), self.review_confirm, (self.image_sa, self.thumbnail_view)),
+                (('F',), self.review_flip, (self.image_sa, self.thumbnail_view))]
+        for sequences, slot, widgets in keys:
+            for widget in widgets:
+                for sequence in sequences:
+                    shortcut = QShortcut(QtGui.QKeySequence(sequence), widget, slot)
+                    shortcut.setContext(QtCore.Qt.ShortcutContext.WidgetWithChildrenShortcut)
+        QShortcut(QtGui.QKeySequence('Ctrl+R'), self, self.review_btn.toggle)
+        self.review_btn.toggled.connect(self.review_toggled)
+
+    def review_toggled(self, checked):
+        if checked:
+            # Клавиши проверки действуют в окне просмотра
+            self.image_sa.setFocus()
+
     def resizeEvent(self, event):
         self.resized.emit()
         return super(MyWidget, self).resizeEvent(event)
 
     def add_grid(self):
+        if all(self.get_check_list()):
+            self.start_proposals(self.project.register_grids, 'поиск сетки слов', 'Сетка не найдена уверенно')
+            return
         if self.image_viewer is not None:
             self.image_viewer.add_grid()
             self.image_sa.show()
@@ -134,17 +196,25 @@ class MyWidget(QMainWindow, Ui_MainWindow):
                 button.show()  # Показываем кнопку
             else:
                 button.hide()  # Скрываем кнопку
+        # Пока проект переходит на следующий этап, его нельзя редактировать,
+        # но можно открыть другой проект
+        busy = self.is_busy()
+        for name, button in self.buttons.items():
+            button.setEnabled(not busy or name in ('new_project', 'open'))
+        self.thumbnails_sa.setEnabled(not busy)
+        self.image_sa.setEnabled(not busy)
+
+    def is_busy(self):
+        """Текущий проект переходит на следующий этап или размечается автоматически."""
+        return any(worker is not None and worker.project is self.project
+                   for worker in (self.step_worker, self.proposal_worker))
 
     def confirm_cut(self):
-        check_list = [x.isChecked() for x in self.check_list]
+        check_list = self.get_check_list()
         if all(check_list):
-            for i in range(len(check_list)):
-                if i in self.project.actions:
-                    draft_action = self.project.actions[i]
-                    self.project.actions[i] = Action(type=draft_action.type,
-                                                     value=draft_action.value,
-                                                     final=True)
-                    self.update_thumbnail(i)
+            for i in self.project.actions.finalize():
+                self.update_thumbnail(i)
+            self.thumbnail_model.unflag(self.project.actions.indices(final=True).tolist())
             self.thumbnail_click()
         else:
             if self.current_image_index in self.project.actions:
@@ -153,8 +223,9 @@ class MyWidget(QMainWindow, Ui_MainWindow):
                                                                         value=draft_action.value,
                                                                         final=True)
                 self.update_thumbnail(self.current_image_index)
+                self.thumbnail_model.unflag([self.current_image_index])
                 self.image_viewer.add_final_line()
-        self.project.save_project()
+        self.autosaver.schedule(self.project)
 
     def delete_cut(self):
         if self.current_image_index in self.project.actions:
@@ -162,44 +233,83 @@ class MyWidget(QMainWindow, Ui_MainWindow):
             self.update_thumbnail(self.current_image_index)
             self.image_viewer.remove_line()
 
+    def get_check_list(self):
+        return self.thumbnail_model.get_check_list()
+
     def check_all(self):
-        check_list = [x.isChecked() for x in self.check_list]
-        if all(check_list):
-            for check_box in self.check_list:
-                check_box.setChecked(False)
-        else:
-            for check_box in self.check_list:
-                check_box.setChecked(True)
+        check_list = self.get_check_list()
+        self.thumbnail_model.set_all_checked(not all(check_list))
 
     def add_vertical(self):
-        check_list = [x.isChecked() for x in self.check_list]
+        check_list = self.get_check_list()
         if all(check_list):
-            for i in range(len(self.files)):
-                image = Image.open(self.files[i])
-                x = image.width // 2
-                self.project.actions[i] = Action('vertical_cut', value=x, final=False)
-                self.thumbnail_click()
+            self.add_cut_to_all()
         else:
             if self.image_viewer is not None:
                 self.image_viewer.add_line()
                 self.image_sa.show()
                 self.sciss_btn.setEnabled(True)
 
+    def add_cut_to_all(self):
+        """Разрез во всех файлах этапа: ищется в отдельном потоке, вид обновляется один раз по окончании."""
+        self.start_proposals(self.project.detect_cuts, 'поиск разрезов', 'Разрез не найден уверенно')
+
+    def start_proposals(self, propose, text, review_text):
+        """
+        Запускает автоматическую разметку всех файлов этапа в отдельном потоке.
+
+        :param propose: Метод проекта (см. ProposalWorker)
+        :param review_text: Начало сообщения о файлах, требующих проверки
+        """
+        if self.step_worker is not None or self.proposal_worker is not None:
+            return
+        # Отложенные изменения записываются до запуска: пока поток меняет действия проекта,
+        # автосохранение не должно собирать их в потоке интерфейса
+        self.autosaver.flush()
+        self.proposal_worker = ProposalWorker(self.project, propose, text, parent=self)
+        self.proposal_worker.progress.connect(self.step_progress)
+        self.proposal_worker.proposals_done.connect(
+            lambda review: self.proposals_found(review, review_text))
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        self.cancel_step_btn.show()
+        self.show_buttons()
+        self.proposal_worker.start()
+
+    def proposals_found(self, review, review_text):
+        worker = self.proposal_worker
+        self.proposal_worker = None
+        self.progress_bar.hide()
+        self.cancel_step_btn.hide()
+        self.show_buttons()
+        if worker.project is not self.project:
+            return
+        if review is None:
+            self.statusbar.showMessage(f'{worker.text.capitalize()}: отменено', 5000)
+            return
+        self.autosaver.schedule(self.project)
+        # Файлы с неуверенной оценкой обводятся красной рамкой
+        self.thumbnail_model.set_flagged(review)
+        if review:
+            self.statusbar.showMessage(f'{review_text} в файлах: {len(review)}, '
+                                       f'они отмечены красной рамкой', 10000)
+        if self.current_image_index is not None:
+            self.thumbnail_click(self.current_image_index)
+
     def contour(self):
+        if all(self.get_check_list()):
+            self.start_proposals(self.project.segment_letters, 'выделение букв', 'Буквы не найдены')
+            return
         if self.image_viewer is not None:
             self.image_viewer.contour()
             self.image_sa.show()
             self.update_thumbnail(self.current_image_index)
-            self.project.save_project()
+            self.autosaver.schedule(self.project)
 
     def add_horizontal(self):
-        check_list = [x.isChecked() for x in self.check_list]
+        check_list = self.get_check_list()
         if all(check_list):
-            for i in range(len(self.files)):
-                image = Image.open(self.files[i])
-                y = image.height // 2
-                self.project.actions[i] = Action('horizontal_cut', value=y, final=False)
-                self.thumbnail_click()
+            self.add_cut_to_all()
         else:
             if self.image_viewer is not None:
                 self.image_viewer.add_line()
@@ -207,6 +317,7 @@ class MyWidget(QMainWindow, Ui_MainWindow):
                 self.sciss_btn.setEnabled(True)
 
     def create_new_project(self):
+        self.autosaver.flush()
         self.project = Project()
         if not self.project.new_project(self):
             return
@@ -233,6 +344,7 @@ class MyWidget(QMainWindow, Ui_MainWindow):
         temp_dir = QFileDialog.getExistingDirectory(self, 'Select Folder')
         if temp_dir == '':
             return False
+        self.autosaver.flush()
         self.project = Project(directory_name=temp_dir)
         if not self.project.load_project():
             return False
@@ -244,89 +356,106 @@ class MyWidget(QMainWindow, Ui_MainWindow):
         self.show_buttons()
 
     def highlight_thumbnail(self, index):
-        # Убираем выделение у всех остальных thumbnails
-        for label in self.labels:
-            label.setStyleSheet("border: none;")
-
-        # Выделяем текущий thumbnail
-        if index >= 0 and index < len(self.labels):
-            self.labels[index].setStyleSheet("border: 2px solid green;")  # Рамка красного цвета
+        if 0 <= index < self.thumbnail_model.rowCount():
+            self.thumbnail_view.setCurrentIndex(self.thumbnail_model.index(index))
 
     def show_thumbnails(self, checked=None):
-        # Если нет параметров, то создаем пустой список
-        if checked is None:
-            checked = []
-        # Очищаем текущий layout
-        if hasattr(self, 'group_box'):
-            self.group_box.deleteLater()
-        # Создаем новый GroupBox
-        group_box = QGroupBox()
-        v_layout = QVBoxLayout()
-        group_box.setLayout(v_layout)
-        # Очищаем списки
-        self.labels.clear()
-        self.check_list.clear()
+        self.current_image_index = None
+        self.thumbnail_model.set_thumbnails(self.thumbnails, checked)
+        self.thumbnails_sa.show()
         if len(self.thumbnails) > 0:
-            v_layout = QVBoxLayout()
-            group_box = QGroupBox()
-            num = 1
-            self.labels.clear()
-            for file in self.thumbnails:
-                mini_v_layout = QVBoxLayout()
-                label_num = QLabel(f'{num}:')
-                check_box = QCheckBox()
-                if len(checked) > num - 1:
-                    check_box.setChecked(checked[num - 1])
-                self.check_list.append(check_box)
-                num += 1
-                label = Mylabel(self)
-                image = Image.open(file)
-                pix = pil2pixmap(image)
-                label.setPixmap(pix.scaled(200, 400, QtCore.Qt.AspectRatioMode.KeepAspectRatio))
-                self.labels.append(label)
-                v_sp = QSpacerItem(20, 40, QSizePolicy.Policy.Minimum, QSizePolicy.Policy.Expanding)
-                mini_v_layout.addWidget(label_num)
-                mini_v_layout.addWidget(check_box)
-                mini_v_layout.addItem(v_sp)
-                h_layout = QHBoxLayout()
-                h_layout.addLayout(mini_v_layout)
-                h_layout.addWidget(label)
-                v_layout.addLayout(h_layout)
-                label.clicked.connect(self.thumbnail_click)
-            group_box.setLayout(v_layout)
-            self.thumbnails_sa.setWidget(group_box)
-            self.thumbnails_sa.show()
             self.thumbnail_click(0)
 
+    def thumbnail_selected(self, current, previous):
+        if current.isValid() and current.row() != self.current_image_index:
+            self.thumbnail_click(current.row())
+
     def thumbnail_click(self, index=None):
+        if index is None:
+            return
         container_size = (self.image_sa.size().width(), self.image_sa.size().height())
-        if index is not None:
-            self.current_image_index = index
-            self.highlight_thumbnail(index)
-            file = self.files[index]
-            self.image_viewer = self.project.create_viewer(file, index, container_size)
+        self.current_image_index = index
+        self.highlight_thumbnail(index)
+        file = self.files[index]
+        # Окно просмотра одно, в нем меняются только изображение и элементы действия
+        self.image_viewer = self.project.create_viewer(file, index, container_size, self.image_viewer)
+        if self.image_sa.widget() is not self.image_viewer:
             self.image_sa.setWidget(self.image_viewer)
-            self.image_sa.show()
+        self.image_sa.show()
+        # Следующие файлы (и предыдущий) декодируются заранее, переход к ним - только смена плиток
+        ahead = self.upcoming(index, READ_AHEAD)
+        pyramid.prefetch([self.files[i] for i in ahead + [index - 1] if 0 <= i < len(self.files)],
+                         container_size)
+
+    def needs_review(self, index):
+        """Файл без подтвержденного действия или с неуверенной автоматической оценкой."""
+        action = self.project.actions.get(index)
+        return action is None or not action.final or index in self.thumbnail_model.flagged
+
+    def upcoming(self, index, count, step=1):
+        """Индексы следующих count файлов (step=-1 - предыдущих); в режиме проверки - только требующих проверки."""
+        result = []
+        i = index + step
+        while 0 <= i < len(self.files) and len(result) < count:
+            if not self.review_btn.isChecked() or self.needs_review(i):
+                result.append(i)
+            i += step
+        return result
+
+    def show_next(self, step=1):
+        if self.project is None or self.current_image_index is None or self.is_busy():
+            return False
+        following = self.upcoming(self.current_image_index, 1, step)
+        if not following:
+            self.statusbar.showMessage('Файлов для проверки больше нет' if self.review_btn.isChecked()
+                                       else 'Это последний файл этапа', 3000)
+            return False
+        self.thumbnail_click(following[0])
+        return True
+
+    def show_previous(self):
+        return self.show_next(-1)
+
+    def review_confirm(self):
+        """Подтверждает действие текущего файла и в режиме проверки переходит к следующему."""
+        if self.project is None or self.current_image_index is None or self.is_busy():
             return
-        for i in range(len(self.labels)):
-            if self.labels[i] == self.sender():
-                file = self.files[i]
-                if self.current_image_index == i:
-                    return
-                self.current_image_index = i
-                self.highlight_thumbnail(i)
-                self.image_viewer = self.project.create_viewer(file, i, container_size)
-                self.image_sa.setWidget(self.image_viewer)
-                self.image_sa.show()
+        index = self.current_image_index
+        action = self.project.actions.get(index)
+        if action is not None and not action.final:
+            self.project.actions[index] = action._replace(final=True)
+            self.update_thumbnail(index)
+            self.autosaver.schedule(self.project)
+        self.thumbnail_model.unflag([index])
+        if self.review_btn.isChecked() and self.show_next():
+            return
+        # Файл остается на экране - показываем подтвержденное действие
+        self.thumbnail_click(index)
+
+    def review_flip(self):
+        if (self.project is None or self.current_image_index is None or self.is_busy() or
+                STEPS[self.project.current_step] != 'orientation'):
+            return
+        self.flip()
+        if self.review_btn.isChecked():
+            self.show_next()
+
+    def refit_viewer(self):
+        if self.image_viewer is not None and self.current_image_index is not None:
+            self.image_viewer.refit((self.image_sa.size().width(), self.image_sa.size().height()))
 
     def update_thumbnail(self, index):
         """Обновляет иконку по индексу."""
         file = self.project.files[index]
-        image = Image.open(file)
-        original_width = image.width
-        original_height = image.height
-        image.thumbnail((400, 400))
-        image = image.convert('RGB')
+        # Полный скан не декодируется: размер берется из заголовка, основа иконки - из кэша
+        # иконок или уменьшенным чтением файла
+        original_width, original_height = vimage.image_size(file)
+        cached = self.project.clean_thumbnail(file)
+        if cached is not None:
+            source = Image.open(cached)
+        else:
+            source = vimage.open_reduced(file, max(thumbnails.THUMBNAIL_SIZE))
+        image = source.convert('RGB')
         if index in self.project.actions:
             action = self.project.actions[index]
             if action.type == 'vertical_cut':
@@ -341,62 +470,116 @@ class MyWidget(QMainWindow, Ui_MainWindow):
                 draw.line((0, y, image.width, y), fill=(0, 255, 0), width=6)
             elif action.type == 'orientation':
                 foreground = Image.open(os.getcwd() + "/images/flip_thumb.png").convert("RGBA")
-                image = Image.open(file).convert('RGBA')
-                image.thumbnail((400, 400))
+                image = source.convert('RGBA')
                 image = image.rotate(180)
                 image.paste(foreground, (250, 150), foreground)
                 image = image.convert('RGB')
             elif action.type == 'rotation':
                 foreground = Image.open(os.getcwd() + "/images/rotation.png").convert("RGBA")
-                image = Image.open(file).convert('RGBA')
-                image.thumbnail((400, 400))
+                image = source.convert('RGBA')
                 image = image.rotate(-action.value)
                 image.paste(foreground, (300, 200), foreground)
                 image = image.convert('RGB')
             elif action.type == 'word_select':
                 foreground = Image.open(os.getcwd() + "/images/grid.png").convert("RGBA")
-                image = Image.open(file).convert('RGBA')
-                image.thumbnail((400, 400))
+                image = source.convert('RGBA')
                 image.paste(foreground, (300, 200), foreground)
                 image = image.convert('RGB')
-        file = (self.project.work_dir + '/processing/' +
-                STEPS[self.project.current_step] + '/' +
-                '/thumbnails/' + os.path.splitext(os.path.basename(file))[0] + '.jpg')
-        image.save(file, format='JPEG')
-        thumbnail = self.labels[index]
-        pix = pil2pixmap(image)
-        thumbnail.setPixmap(pix.scaled(200, 400, QtCore.Qt.AspectRatioMode.KeepAspectRatio))
+        file = self.project.get_thumbnail_name(self.project.current_step, file)
+        # Иконка может быть ссылкой на общий кэш иконок - записывается новый файл
+        pipeline.save_image(image, file)
+        self.thumbnail_model.set_pixmap(index, pil2pixmap(image))
 
     def next_step(self):
-        check_list = [x.isChecked() for x in self.check_list]
+        if self.step_worker is not None:
+            return
+        check_list = self.get_check_list()
         if not all(check_list):
             reply = QMessageBox.question(None, 'Переход на следующий этап',
                                          'Будут обработаны только отмеченные файлы, пометить все файлы перед переходом?',
                                          QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
                                          QMessageBox.StandardButton.Yes)
 
-            if reply == QMessageBox.Yes:
+            if reply == QMessageBox.StandardButton.Yes:
                 self.check_all()
-                check_list = [x.isChecked() for x in self.check_list]
+                check_list = self.get_check_list()
         self.save_project()
         self.project.set_check_list(check_list)
-        cur_step = self.project.next_step()
+        # Обработка идет в отдельном потоке, интерфейс продолжает отвечать
+        self.step_worker = StepWorker(self.project, parent=self)
+        self.step_worker.progress.connect(self.step_progress)
+        self.step_worker.step_done.connect(self.step_finished)
+        self.progress_bar.setValue(0)
+        self.progress_bar.show()
+        self.cancel_step_btn.show()
+        self.show_buttons()
+        self.step_worker.start()
+
+    def previous_step(self):
+        if self.step_worker is not None:
+            return
+        # Отложенные изменения записываются до смены этапа
+        self.save_project()
+        if not self.project.previous_step():
+            return
+        self.files = self.project.load_current_files()
+        self.thumbnails = self.project.get_current_thumbnails()
+        self.checked = self.project.get_current_check_list()
+        self.show_thumbnails(self.checked)
+        self.setWindowTitle('Обработка изображений - ' + TEXT_STEPS[self.project.current_step])
+        self.show_buttons()
+
+    def step_progress(self, done, total, text):
+        self.progress_bar.setMaximum(total)
+        self.progress_bar.setValue(done)
+        self.progress_bar.setFormat(f'{text}: %v из %m')
+
+    def cancel_step(self):
+        for worker in (self.step_worker, self.proposal_worker):
+            if worker is not None:
+                worker.cancel()
+
+    def step_finished(self, cur_step):
+        worker = self.step_worker
+        self.step_worker = None
+        self.progress_bar.hide()
+        self.cancel_step_btn.hide()
+        project = worker.project
+        if project.errors:
+            QMessageBox.warning(None, 'Переход на следующий этап',
+                                'Не удалось обработать файлы:\n' +
+                                '\n'.join(f'{os.path.basename(f)}: {e}' for f, e in project.errors[:20]))
+        if project is not self.project:
+            # Пока шла обработка, оператор открыл другой проект
+            if cur_step:
+                self.statusbar.showMessage(f'Проект {project.work_dir}: выполнен переход на этап '
+                                           f'"{TEXT_STEPS[project.current_step]}"', 10000)
+            self.show_buttons()
+            return
         if cur_step:
             self.files = self.project.load_current_files()
             self.thumbnails = self.project.get_current_thumbnails()
             self.checked = self.project.get_current_check_list()
             self.show_thumbnails(self.checked)
             self.setWindowTitle('Обработка изображений - ' + TEXT_STEPS[self.project.current_step])
-            self.show_buttons()
+            # Предложения, сделанные при переходе (например, неуверенный наклон), отмечаются красной рамкой
+            self.thumbnail_model.set_flagged(self.project.review)
+            if self.project.review:
+                self.statusbar.showMessage(f'Требуют проверки файлов: {len(self.project.review)}, '
+                                           f'они отмечены красной рамкой', 10000)
+        elif worker.is_cancelled():
+            self.statusbar.showMessage('Переход на следующий этап отменен', 5000)
         else:
             print('Ошибка при переходе')
+        self.show_buttons()
 
     def flip(self):
         if self.image_viewer is not None:
             self.image_viewer.flip()
             self.image_sa.show()
             self.update_thumbnail(self.current_image_index)
-            self.project.save_project()
+            self.thumbnail_model.unflag([self.current_image_index])
+            self.autosaver.schedule(self.project)
 
     def confirm(self):
         if self.current_image_index in self.project.actions:
@@ -405,8 +588,9 @@ class MyWidget(QMainWindow, Ui_MainWindow):
                                                                     value=draft_action.value,
                                                                     final=True)
             self.update_thumbnail(self.current_image_index)
+            self.thumbnail_model.unflag([self.current_image_index])
             self.image_viewer.fix_rotation()
-        self.project.save_project()
+        self.autosaver.schedule(self.project)
 
     def rotate(self):
         if self.image_viewer is not None:
@@ -423,8 +607,7 @@ class MyWidget(QMainWindow, Ui_MainWindow):
             font=font,
             fill='#FF0000'
         )
-        pix = pil2pixmap(im)
-        self.labels[self.current_image_index].setPixmap(pix.scaled(200, 400, QtCore.Qt.KeepAspectRatio))
+        self.thumbnail_model.set_pixmap(self.current_image_index, pil2pixmap(im))
 
     def generate_thumbnails(self):
         self.thumbnails = []
@@ -435,8 +618,7 @@ class MyWidget(QMainWindow, Ui_MainWindow):
         except OSError:
             return False
         for file in self.files:
-            image = Image.open(file)
-            image.thumbnail((400, 400))
+            image = imagecache.thumbnail(imagecache.open_image(file))
             new_name = self.work_dir + '/thumbnails/' + os.path.basename(file)
             image.save(new_name)
             self.thumbnails.append(new_name)
@@ -469,7 +651,18 @@ class MyWidget(QMainWindow, Ui_MainWindow):
             pic.setFlags(QGraphicsItem.ItemIsSelectable | QGraphicsItem.ItemIsMovable)
 
     def save_project(self):
-        self.project.save_project()
+        if self.project is None:
+            return
+        self.autosaver.schedule(self.project)
+        self.autosaver.flush()
+
+    def closeEvent(self, event):
+        for worker in (self.step_worker, self.proposal_worker):
+            if worker is not None:
+                worker.cancel()
+                worker.wait()
+        self.autosaver.stop()
+        super().closeEvent(event)
 
 
 def excepthook(exc_type, exc_value, exc_tb):
@@ -0,0 +1,79 @@
+'''Поиск линии разреза листа на две половины (этапы vertical_cut и horizontal_cut).
+
+Граница между половинами разворота ищется по профилю яркости уменьшенного
+изображения: среднее затемнение каждого столбца (для горизонтального
+разреза - строки). Сгиб или тень корешка дает темный пик профиля, поле
+между страницами - светлый провал. Ищется самый выраженный из них в
+средней части листа; насколько он выделяется на фоне остального профиля,
+определяет уверенность оценки (от 0 до 1).
+'''
+import numpy as np
+
+import vimage
+
+ANALYSIS_SIZE = 1000  # большая сторона уменьшенного изображения
+SEARCH_BAND = (0.3, 0.7)  # разрез ищется в этой доле ширины (высоты) листа
+SMOOTH = 0.005  # ширина сглаживания профиля, доля длины
+STRONG_CONTRAST = 4.0  # выделение в стандартных отклонениях, дающее уверенность 1
+MIN_CONFIDENCE = 0.5
+
+
+def darkness_profile(gray, axis):
+    """Среднее затемнение (0 - белый, 1 - черный) столбцов (axis=0) или строк (axis=1), сглаженное."""
+    profile = 1 - gray.mean(axis=axis) / 255
+    width = max(1, round(len(profile) * SMOOTH))
+    if width > 1:
+        profile = np.convolve(profile, np.ones(width) / width, mode='same')
+    return profile
+
+
+def find_cut(profile):
+    """
+    Положение разреза в профиле и уверенность.
+
+    :return: (индекс в профиле, уверенность); при невыраженном профиле - середина и 0
+    """
+    n = len(profile)
+    middle = n // 2
+    lo, hi = int(n * SEARCH_BAND[0]), int(n * SEARCH_BAND[1])
+    if hi - lo < 3:
+        return middle, 0.0
+    spread = float(profile.std())
+    if spread < 1e-3:
+        return middle, 0.0
+    median = float(np.median(profile))
+    band = profile[lo:hi]
+    # Темный пик - сгиб, тень корешка или линия
+    peak = lo + int(np.argmax(band))
+    dark = (profile[peak] - median) / spread
+    # Светлый провал - поле между страницами; берется середина самого светлого участка
+    valley = int(np.argmin(band))
+    level = band[valley] + 0.1 * (median - band[valley])
+    light = band <= level
+    start = valley
+    while start > 0 and light[start - 1]:
+        start -= 1
+    end = valley
+    while end < len(band) - 1 and light[end + 1]:
+        end += 1
+    gap = lo + (start + end) // 2
+    bright = (median - band[valley]) / spread
+    position, contrast = (peak, dark) if dark >= bright else (gap, bright)
+    return position, round(float(np.clip(contrast / STRONG_CONTRAST, 0, 1)), 3)
+
+
+def detect_cut(file, cut_type):
+    """
+    Положение разреза файла (обычного или .vimg) в пикселях исходного изображения и уверенность.
+
+    :param cut_type: 'vertical_cut' (координата X) или 'horizontal_cut' (координата Y)
+    """
+    width, height = vimage.image_size(file)
+    gray = np.asarray(vimage.open_reduced(file, ANALYSIS_SIZE).convert('L'), dtype=np.float32)
+    if cut_type == 'vertical_cut':
+        position, confidence = find_cut(darkness_profile(gray, 0))
+        scale = width / gray.shape[1]
+    else:
+        position, confidence = find_cut(darkness_profile(gray, 1))
+        scale = height / gray.shape[0]
+    return int((position + 0.5) * scale), confidence
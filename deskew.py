@@ -0,0 +1,78 @@
+'''Оценка наклона сканов для этапа выравнивания (rotation).
+
+Наклон ищется по горизонтальным проекциям темных пикселей уменьшенного
+изображения: при правильном угле строки текста и линии бланка дают резкие
+пики профиля. Все углы проверяются одновременно (одна гистограмма на угол
+через np.bincount), сначала грубо, затем уточняются около лучшего.
+
+Оценка возвращает угол в градусах в соглашении действия 'rotation'
+(положительный - поворот по часовой стрелке, см. pipeline.apply_action)
+и уверенность от 0 до 1. Уверенные оценки записываются как готовые
+действия, остальные - как предложения для проверки оператором.
+'''
+import cv2
+import numpy as np
+
+import vimage
+
+MAX_ANGLE = 10  # градусов в обе стороны
+COARSE_STEP = 0.5
+FINE_STEP = 0.05
+ANALYSIS_SIZE = 1000  # большая сторона уменьшенного изображения
+MAX_POINTS = 50000  # темных пикселей в оценке
+MIN_INK = 0.001  # доля темных пикселей, меньше - пустая страница
+MIN_CONFIDENCE = 0.3
+
+
+def ink_points(gray):
+    """Координаты (y, x) темных пикселей изображения (порог Оцу) или None для пустой страницы."""
+    _, ink = cv2.threshold(gray, 0, 1, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    ys, xs = np.nonzero(ink)
+    if len(ys) < MIN_INK * gray.size:
+        return None
+    step = -(-len(ys) // MAX_POINTS)
+    return ys[::step].astype(np.float32), xs[::step].astype(np.float32)
+
+
+def projection_scores(ys, xs, angles):
+    """Резкость горизонтального профиля (сумма квадратов) для каждого угла angles."""
+    radians = np.radians(angles).astype(np.float32)
+    # Проекция точки на нормаль к строке, наклоненной на угол
+    r = np.outer(np.cos(radians), ys) + np.outer(np.sin(radians), xs)
+    r -= r.min()
+    bins = int(r.max()) + 1
+    index = r.astype(np.int64) + (np.arange(len(angles)) * bins)[:, None]
+    counts = np.bincount(index.ravel(), minlength=len(angles) * bins).reshape(len(angles), bins)
+    return (counts.astype(np.float64) ** 2).sum(axis=1)
+
+
+def estimate_skew(gray, max_angle=MAX_ANGLE):
+    """
+    Наклон изображения в градусах (положительный - строки поднимаются вправо) и уверенность.
+
+    :param gray: Уменьшенное изображение в оттенках серого (массив uint8)
+    :return: (угол, уверенность); для пустой страницы (0.0, 0.0)
+    """
+    points = ink_points(gray)
+    if points is None:
+        return 0.0, 0.0
+    ys, xs = points
+    limit = max_angle + COARSE_STEP
+    coarse = np.arange(-limit, limit + COARSE_STEP / 2, COARSE_STEP)
+    scores = projection_scores(ys, xs, coarse)
+    best = int(np.argmax(scores))
+    # Насколько лучший угол выделяется среди остальных
+    confidence = 1 - float(np.median(scores)) / float(scores[best])
+    fine = np.arange(coarse[best] - COARSE_STEP, coarse[best] + COARSE_STEP + FINE_STEP / 2, FINE_STEP)
+    fine_scores = projection_scores(ys, xs, fine)
+    angle = round(float(fine[int(np.argmax(fine_scores))]), 2) + 0.0
+    if abs(angle) > max_angle:
+        # Настоящий угол, скорее всего, за пределами диапазона - оценке верить нельзя
+        return 0.0, 0.0
+    return angle, round(confidence, 3)
+
+
+def estimate_file(file, max_angle=MAX_ANGLE):
+    """Наклон и уверенность для файла (обычного или .vimg)."""
+    gray = np.asarray(vimage.open_reduced(file, ANALYSIS_SIZE).convert('L'))
+    return estimate_skew(gray, max_angle)
@@ -3,11 +3,14 @@
 # Этот код загружает изображение, применяет маску для поиска чёрных квадратов размером 20–50 пикселей, находит контуры
 # найденных квадратов и сохраняет их координаты в списке.
 import cv2
-# import numpy as np
+import numpy as np
 from PIL import Image
 from PyQt6.QtGui import QImage, QPixmap
+import hashlib
 import os
 import sqlite3
+from storage import ProjectStore
+import gridreg
 
 def overlay_image(source_image_path, overlay_image_path, output_image_path, position=(0, 0)):
     try:
@@ -35,90 +38,75 @@ def overlay_image(source_image_path, overlay_image_path, output_image_path, posi
 def create_project_database(path:str)->bool:
     last_directory_name = os.path.basename(os.path.normpath(path))
     db_name = f"{path}/{last_directory_name}.db"
-    conn = sqlite3.connect(db_name)
     try:
-        cursor = conn.cursor()
-        create_table_query = f"""
-        CREATE TABLE IF NOT EXISTS project_info (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            path TEXT NOT NULL,
-            curr_step INTEGER
-        );
-        """
-        cursor.execute(create_table_query)
-        create_table_query = f"""
-        CREATE TABLE IF NOT EXISTS source_files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            full_path TEXT,
-            base_name TEXT
-        );
-        """
-        cursor.execute(create_table_query)
-        create_table_query = f"""
-        CREATE TABLE IF NOT EXISTS step_info (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            step INTEGER,
-            file_id INTEGER,
-            oper_str TEXT
-        );
-        """
-        cursor.execute(create_table_query)
-        create_table_query = f"""
-        CREATE TABLE IF NOT EXISTS res_files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            source_file INTEGER,
-            res_file INTEGER
-        );
-        """
-        cursor.execute(create_table_query)
-        conn.commit()
+        ProjectStore(db_name).close()
         return True
-
     except sqlite3.Error as e:
         return False
 
-    finally:
-        conn.close()
+
+def file_digest(path, chunk_size=1 << 20):
+    """SHA-1 содержимого файла."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Режимы PIL, данные которых QImage принимает без перестановки каналов: (формат, байт на пиксель)
+QIMAGE_FORMATS = {
+    "RGB": (QImage.Format.Format_RGB888, 3),
+    "RGBA": (QImage.Format.Format_RGBA8888, 4),
+    "L": (QImage.Format.Format_Grayscale8, 1),
+}
+
+
+def pil2qimage(image):
+    """
+    QImage с пикселями изображения PIL. Данные копируются один раз (tobytes) в том же
+    порядке каналов, что и у PIL; остальные режимы сначала приводятся к RGB или RGBA.
+    """
+    if image.mode not in QIMAGE_FORMATS:
+        has_alpha = "A" in image.getbands() or "transparency" in image.info
+        image = image.convert("RGBA" if has_alpha else "RGB")
+    image_format, depth = QIMAGE_FORMATS[image.mode]
+    data = image.tobytes("raw", image.mode)
+    qim = QImage(data, image.width, image.height, image.width * depth, image_format)
+    # QImage не владеет буфером bytes - копия делается только вместе с данными
+    qim.data_ref = data
+    return qim
 
 
 def pil2pixmap(image):
-    if image.mode == "RGB":
-        r, g, b = image.split()
-        im = Image.merge("RGB", (b, g, r))
-    elif image.mode == "RGBA":
-        r, g, b, a = image.split()
-        im = Image.merge("RGBA", (b, g, r, a))
-    elif image.mode == "L":
-        im = image.convert("RGBA")
-    im2 = im.convert("RGBA")
-    data = im2.tobytes("raw", "RGBA")
-    qim = QImage(data, im.size[0], im.size[1], QImage.Format.Format_ARGB32)
-    pixmap = QPixmap.fromImage(qim)
-    return pixmap
+    return QPixmap.fromImage(pil2qimage(image))
+
+
+def cv2_to_qimage(cv_img):
+    """QImage над массивом OpenCV (BGR, BGRA или оттенки серого) без cvtColor."""
+    cv_img = np.ascontiguousarray(cv_img)
+    height, width = cv_img.shape[:2]
+    if cv_img.ndim == 2:
+        image_format = QImage.Format.Format_Grayscale8
+    elif cv_img.shape[2] == 4:
+        # BGRA в памяти - это ARGB32 на little-endian
+        image_format = QImage.Format.Format_ARGB32
+    else:
+        image_format = QImage.Format.Format_BGR888
+    qim = QImage(cv_img.data, width, height, cv_img.strides[0], image_format)
+    qim.data_ref = cv_img
+    return qim
+
 
 # Функция преобразования изображения OpenCV в QPixmap
 def cv2_to_qpixmap(cv_img):
-    rgb_img = cv2.cvtColor(cv_img, cv2.COLOR_BGR2RGB)
-    height, width, channels = rgb_img.shape
-    bytes_per_line = channels * width
-    q_img = QImage(rgb_img.data, width, height, bytes_per_line, QImage.Format.Format_RGB888)
-    return QPixmap.fromImage(q_img)
+    return QPixmap.fromImage(cv2_to_qimage(cv_img))
+
 
 def squares_coord(file_name, min_size=10, max_size=100):
-    img = cv2.imread(file_name)
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    ret, thresh = cv2.threshold(gray, 50, 255, 0)
-    contours, hierarchy = cv2.findContours(thresh, 1, 2)
-    result = []
-    for cnt in contours:
-        x1, y1 = cnt[0][0]
-        approx = cv2.approxPolyDP(cnt, 0.01 * cv2.arcLength(cnt, True), True)
-        if len(approx) == 4:
-            x, y, w, h = cv2.boundingRect(cnt)
-            ratio = float(w) / h
-            if 0.9 <= ratio <= 1.1:
-                result.append([x1, y1, x1 + w, y1 + h])
-    return result
+    """Координаты сплошных черных квадратов (меток бланка): список [x1, y1, x2, y2]."""
+    gray = np.asarray(Image.open(file_name).convert('L'))
+    return [list(box) for box in gridreg.find_markers(gray, min_size, max_size)]
 
 
 if __name__ == '__main__':
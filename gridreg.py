@@ -0,0 +1,94 @@
+'''Привязка сетки слов бланка по черным квадратам-меткам (этап word_select).
+
+На бланке в углах сетки слов напечатаны сплошные черные квадраты. Они
+находятся как связные области темных пикселей квадратной формы, затем
+по угловым меткам подбирается подобие (сдвиг, масштаб, небольшой поворот),
+переводящее схему бланка в изображение. Начало сетки в изображении -
+значение действия word_select, отклонение масштаба и поворота и невязка
+меток определяют уверенность.
+'''
+import math
+
+import cv2
+import numpy as np
+
+import vimage
+from layout import MARKERS
+MARKER_SIZE = (10, 100)  # сторона метки в пикселях исходного изображения
+ANALYSIS_SCALE = 2  # изображение уменьшается в 2 раза
+DARK_LEVEL = 80  # пиксели темнее считаются чернилами
+MIN_FILL = 0.85  # доля закрашенных пикселей в квадрате метки
+MATCH_TOLERANCE = 60  # допуск сопоставления меток до уточнения, пикселей
+MAX_RESIDUAL = 20  # наибольшая невязка меток, пикселей
+MAX_SCALE_ERROR = 0.05
+MAX_ANGLE = 3  # градусов
+MIN_CONFIDENCE = 0.5
+
+
+def find_markers(gray, min_size=MARKER_SIZE[0], max_size=MARKER_SIZE[1]):
+    """Сплошные черные квадраты изображения: список (x1, y1, x2, y2)."""
+    ink = (gray < DARK_LEVEL).astype(np.uint8)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    # Нулевая компонента - фон
+    x, y, w, h, area = stats[1:].T
+    keep = ((w >= min_size) & (w <= max_size) & (h >= min_size) & (h <= max_size) &
+            (np.abs(w - h) <= 0.1 * np.maximum(w, h)) & (area >= MIN_FILL * w * h))
+    return [(int(a), int(b), int(a + c), int(b + d)) for a, b, c, d in zip(x[keep], y[keep], w[keep], h[keep])]
+
+
+def fit_similarity(model, points):
+    """
+    Подобие w = a * z + b (точки как комплексные числа), ближайшее в смысле наименьших квадратов.
+
+    :return: (a, b)
+    """
+    z = np.array([complex(*p) for p in model])
+    w = np.array([complex(*p) for p in points])
+    zc, wc = z - z.mean(), w - w.mean()
+    a = (wc * zc.conj()).sum() / (np.abs(zc) ** 2).sum()
+    return a, w.mean() - a * z.mean()
+
+
+def register(markers):
+    """
+    Положение сетки по найденным меткам.
+
+    :param markers: Список (x1, y1, x2, y2) в координатах изображения
+    :return: ((x, y) начала сетки, масштаб, угол в градусах, уверенность) или None
+    """
+    if len(markers) < 2:
+        return None
+    centers = np.array([((x1 + x2) / 2, (y1 + y2) / 2) for x1, y1, x2, y2 in markers])
+    model = np.array(MARKERS, dtype=float)
+    # Сдвиг схемы, при котором с метками изображения совпадает больше всего меток схемы
+    # (поворот уже исправлен на этапе rotation, поэтому совпадение ищется с допуском)
+    shifts = (centers[:, None, :] - model[None, :, :]).reshape(-1, 2)
+    distances = np.linalg.norm(centers[None, :, None, :] - model[None, None, :, :] - shifts[:, None, None, :],
+                               axis=3)  # [сдвиг, метка изображения, метка схемы]
+    nearest = distances.min(axis=1)
+    votes = (nearest < MATCH_TOLERANCE).sum(axis=1)
+    best = int(np.argmax(votes - nearest.clip(max=MATCH_TOLERANCE).sum(axis=1) / (MATCH_TOLERANCE * 10)))
+    pairs = [(MARKERS[k], centers[int(np.argmin(distances[best, :, k]))])
+             for k in range(len(MARKERS)) if nearest[best, k] < MATCH_TOLERANCE]
+    if len(pairs) < 2:
+        return None
+    model, points = zip(*pairs)
+    a, b = fit_similarity(model, points)
+    residual = max(abs(a * complex(*m) + b - complex(*p)) for m, p in pairs)
+    scale, angle = abs(a), math.degrees(np.angle(a))
+    confidence = len(pairs) / len(MARKERS) * max(0.0, 1 - residual / MAX_RESIDUAL)
+    if len(pairs) < 3 or abs(scale - 1) > MAX_SCALE_ERROR or abs(angle) > MAX_ANGLE:
+        # Две метки не проверяют друг друга, а сильное искажение - признак ложных меток
+        confidence = 0.0
+    return ((round(float(b.real), 1), round(float(b.imag), 1)), round(float(scale), 4),
+            round(angle, 2) + 0.0, round(float(confidence), 3))
+
+
+def register_file(file):
+    """Положение сетки в файле (обычном или .vimg); см. register."""
+    width, height = vimage.image_size(file)
+    image = vimage.open_reduced(file, max(width, height) // ANALYSIS_SCALE)
+    factor = width / image.width
+    gray = np.asarray(image.convert('L'))
+    markers = find_markers(gray, MARKER_SIZE[0] / factor, MARKER_SIZE[1] / factor)
+    return register([tuple(v * factor for v in box) for box in markers])
@@ -0,0 +1,140 @@
+'''Кэш декодированных изображений и их размеров.
+
+Один и тот же файл открывают окно просмотра, переворот и поворот в окне,
+перерисовка иконки и массовое добавление разрезов. Кэш общий для всего
+процесса: изображение декодируется один раз, пока файл не изменился
+(ключ - путь, время изменения и размер файла) и пока хватает бюджета памяти.
+
+Изображения из кэша общие, их нельзя изменять на месте (thumbnail, paste):
+такие операции выполняются над копией.
+'''
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import ImageOps
+
+import vimage
+
+# Бюджет памяти можно задать переменной окружения CROPPER_CACHE_MB или через cache.configure()
+DEFAULT_MAX_BYTES = int(os.environ.get('CROPPER_CACHE_MB', 512)) * 1024 * 1024
+DEFAULT_MAX_SIZES = 100000
+# Байт на пиксель для режимов, где это не число каналов
+MODE_BYTES = {'1': 1, 'I': 4, 'F': 4, 'I;16': 2, 'RGB': 4, 'YCbCr': 4, 'LAB': 4, 'HSV': 4}
+
+
+def file_stamp(path):
+    """Отметка версии файла; для описания учитывается и исходный файл."""
+    st = os.stat(path)
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    if vimage.is_virtual(path):
+        source = vimage.source_path(path, vimage.read_virtual(path))
+        st = os.stat(source)
+        stamp += (st.st_mtime_ns, st.st_size, st.st_ino)
+    return stamp
+
+
+def image_bytes(image):
+    return image.width * image.height * MODE_BYTES.get(image.mode, len(image.getbands()))
+
+
+class ImageCache:
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, max_sizes=DEFAULT_MAX_SIZES):
+        self.max_bytes = max_bytes
+        self.max_sizes = max_sizes
+        self.lock = threading.Lock()
+        self.images = OrderedDict()  # {путь: (отметка, изображение, байт)}
+        self.sizes = OrderedDict()  # {путь: (отметка, (ширина, высота))}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def configure(self, max_bytes=None, max_sizes=None):
+        """Меняет бюджет кэша; лишние изображения сразу вытесняются."""
+        with self.lock:
+            if max_bytes is not None:
+                self.max_bytes = max_bytes
+            if max_sizes is not None:
+                self.max_sizes = max_sizes
+            self._evict()
+
+    def _evict(self):
+        while self.images and self.total_bytes > self.max_bytes:
+            _, (_, _, nbytes) = self.images.popitem(last=False)
+            self.total_bytes -= nbytes
+        while len(self.sizes) > self.max_sizes:
+            self.sizes.popitem(last=False)
+
+    def _drop(self, path):
+        entry = self.images.pop(path, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def get(self, path):
+        """Декодированное изображение файла (обычного или .vimg)."""
+        path = os.path.abspath(path)
+        stamp = file_stamp(path)
+        with self.lock:
+            entry = self.images.get(path)
+            if entry is not None and entry[0] == stamp:
+                self.images.move_to_end(path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        image = vimage.open_image(path)
+        image.load()
+        nbytes = image_bytes(image)
+        with self.lock:
+            self._drop(path)
+            if nbytes <= self.max_bytes:
+                self.images[path] = (stamp, image, nbytes)
+                self.total_bytes += nbytes
+            self.sizes[path] = (stamp, image.size)
+            self.sizes.move_to_end(path)
+            self._evict()
+        return image
+
+    def size(self, path):
+        """Размер изображения; пиксели не декодируются."""
+        path = os.path.abspath(path)
+        stamp = file_stamp(path)
+        with self.lock:
+            entry = self.sizes.get(path)
+            if entry is not None and entry[0] == stamp:
+                self.sizes.move_to_end(path)
+                return entry[1]
+        size = tuple(vimage.image_size(path))
+        with self.lock:
+            self.sizes[path] = (stamp, size)
+            self._evict()
+        return size
+
+    def invalidate(self, path=None):
+        """Забывает файл path или, без аргумента, все файлы."""
+        with self.lock:
+            if path is None:
+                self.images.clear()
+                self.sizes.clear()
+                self.total_bytes = 0
+            else:
+                path = os.path.abspath(path)
+                self._drop(path)
+                self.sizes.pop(path, None)
+
+
+cache = ImageCache()
+
+
+def open_image(path):
+    return cache.get(path)
+
+
+def image_size(path):
+    return cache.size(path)
+
+
+def thumbnail(image, size=(400, 400)):
+    """Уменьшенная копия изображения, не больше size (как Image.thumbnail, но без изменения image)."""
+    if image.width <= size[0] and image.height <= size[1]:
+        return image.copy()
+    return ImageOps.contain(image, size)
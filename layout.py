@@ -0,0 +1,21 @@
+'''Разметка бланка: размер сетки слов, области слов и метки в ней.
+
+Модуль не импортирует других модулей программы, поэтому его можно
+подключать откуда угодно без циклических импортов.
+'''
+
+# Размер сетки слов бланка
+GRID_WIDTH = 3240
+GRID_HEIGHT = 2000
+# Области слов бланка относительно левого верхнего угла сетки
+IMAGE_PARTS = [(0, 0, 1675, 152), (1795, 0, 2155, 152),
+               (2395, 0, 2875, 152), (2995, 0, 3235, 152),
+               (120, 185, 1560, 337), (1795, 185, 3235, 337)]
+for _i in range(2, 11):
+    IMAGE_PARTS.append((120, _i * 185, 1560, _i * 185 + 152))
+    IMAGE_PARTS.append((1795, _i * 185, 3235, _i * 185 + 152))
+# Центры черных квадратов-меток бланка относительно левого верхнего угла сетки.
+# Метки напечатаны в углах прямоугольника GRID_WIDTH x GRID_HEIGHT - того же,
+# что рисуется на этапе word_select и от начала которого отсчитываются
+# IMAGE_PARTS, поэтому найденные метки сразу дают начало сетки
+MARKERS = ((0, 0), (GRID_WIDTH, 0), (0, GRID_HEIGHT), (GRID_WIDTH, GRID_HEIGHT))
@@ -0,0 +1,240 @@
+'''Применение действий этапа к файлам, в том числе в пуле процессов.
+
+Функции модуля не зависят от Qt и от объекта Project, поэтому их можно
+выполнять в дочерних процессах: каждый файл обрабатывается независимо.
+'''
+import os
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from math import ceil
+from typing import Callable, NamedTuple, Optional
+
+from PIL import Image
+
+import vimage
+from blobstore import BlobStore, link_file
+from layout import IMAGE_PARTS
+
+
+def output_name(out_dir, file, suffix=''):
+    """Имя файла следующего этапа: к имени исходного файла добавляется суффикс."""
+    stem, ext, _ = vimage.split_name(file)
+    return out_dir + '/' + stem + suffix + ext
+
+
+def save_image(image, path):
+    """Сохраняет изображение в новый файл: прежний файл может быть ссылкой на общее изображение хранилища."""
+    if os.path.lexists(path):
+        os.remove(path)
+    image.save(path)
+
+
+def pass_file(file, new_file):
+    """Переносит файл на следующий этап без изменений; описание остается описанием."""
+    new_file = vimage.target_name(new_file, vimage.is_virtual(file))
+    link_file(file, new_file)
+    return new_file
+
+
+def save_derived(file, ops, new_file, virtual, image=None):
+    """
+    Сохраняет результат преобразований ops файла file.
+
+    :param virtual: Записать описание вместо изображения
+    :param image: Уже преобразованное изображение, если пиксели были декодированы
+    :return: Имя созданного файла
+    """
+    if virtual:
+        new_file = vimage.target_name(new_file, True)
+        vimage.write_virtual(new_file, vimage.derive(file, *ops))
+        return new_file
+    if image is None:
+        image = vimage.apply_ops(vimage.open_image(file), ops)
+    new_file = vimage.target_name(new_file, False)
+    save_image(image, new_file)
+    return new_file
+
+
+def crop_image(file, crop_params, out_dir):
+    """
+    Обрезает изображение с учетом отрицательной координаты x.
+
+    :param file: Имя входного файла изображения (или описания)
+    :param crop_params: Кортеж (x, y)
+    :param out_dir: Папка следующего этапа
+    :return: Список созданных файлов
+    """
+    if vimage.is_virtual(file):
+        # Исходный скан декодируется один раз, каждое слово берется из него
+        # одним преобразованием всей цепочки
+        source, matrix, size = vimage.prepare(file)
+        height = size[1]
+
+        def crop(box):
+            return vimage.sample(source, matrix, size, box)
+    else:
+        image = Image.open(file)
+        height = image.height
+        crop = image.crop
+    x, y = crop_params
+    # При отрицательном x слева от изображения добавляется белое поле шириной pad
+    pad = ceil(abs(x)) if x < 0 else 0
+    outputs = []
+    for i in range(len(IMAGE_PARTS)):
+        p = IMAGE_PARTS[i]
+        left = (x if x >= 0 else -pad) + p[0]
+        box = tuple(round(v) for v in (left, y + p[1], left + p[2] - p[0], y + p[3]))
+        cropped_image = crop(box)
+        if pad:
+            cropped_image = cropped_image.convert('RGB')
+            if box[0] < 0:
+                white = (0, max(0, -box[1]), min(-box[0], box[2] - box[0]), min(box[3], height) - box[1])
+                if white[3] > white[1]:
+                    cropped_image.paste((255, 255, 255), white)
+        output_file = output_name(out_dir, file, 'w' + str(i).zfill(2))
+        save_image(cropped_image, output_file)
+        outputs.append(output_file)
+    return outputs
+
+
+def apply_action(file, action, out_dir, virtual=False):
+    """
+    Применяет действие к файлу и возвращает список созданных файлов.
+
+    :param virtual: Вместо промежуточных изображений записывать описания (см. vimage);
+        описание на входе всегда дает описания на выходе
+    """
+    virtual = virtual or vimage.is_virtual(file)
+    if action.type == 'vertical_cut':
+        # Координата X для вертикального разреза; размер берется из заголовка файла
+        width, height = vimage.image_size(file)
+        cut_position = action.value
+        boxes = [(0, 0, cut_position, height), (cut_position, 0, width, height)]
+        names = [output_name(out_dir, file, 'v0'), output_name(out_dir, file, 'v1')]
+    elif action.type == 'horizontal_cut':
+        # Координата Y для горизонтального разреза
+        width, height = vimage.image_size(file)
+        cut_position = action.value
+        boxes = [(0, 0, width, cut_position), (0, cut_position, width, height)]
+        names = [output_name(out_dir, file, 'h0'), output_name(out_dir, file, 'h1')]
+    elif action.type == 'orientation':
+        # Исходный файл этапа не перезаписывается, иначе повторный проход перевернет его еще раз
+        return [save_derived(file, [('rotate', 180, False)], output_name(out_dir, file), virtual)]
+    elif action.type == 'rotation':
+        new_name = output_name(out_dir, file)
+        if action.value == 0:
+            return [pass_file(file, new_name)]
+        return [save_derived(file, [('rotate', -action.value, False)], new_name, virtual)]
+    elif action.type == 'word_select':
+        return crop_image(file, action.value, out_dir)
+    else:
+        return []
+    if virtual:
+        return [save_derived(file, [('crop', box)], name, True) for box, name in zip(boxes, names)]
+    image = vimage.open_image(file)
+    return [save_derived(file, None, name, False, image.crop(box)) for box, name in zip(boxes, names)]
+
+
+def process_file(step, file, action, out_dir, virtual=False):
+    """Обрабатывает один файл этапа step: применяет действие или переносит файл без изменений."""
+    if action is not None:
+        return apply_action(file, action, out_dir, virtual)
+    if step in (0, 1, 2):
+        # Наклон оценивается уже на этапе rotation (см. deskew), здесь файл переносится как есть
+        return [pass_file(file, output_name(out_dir, file))]
+    return []
+
+
+class StepTask(NamedTuple):
+    index: int  # индекс файла в списке этапа
+    step: int
+    file: str
+    action: Optional[tuple]
+    out_dir: str
+    blobs_dir: Optional[str]  # хранилище изображений или None
+    virtual: bool = False  # записывать описания вместо промежуточных изображений
+
+
+def _run_task(task):
+    try:
+        outputs = process_file(task.step, task.file, task.action, task.out_dir, task.virtual)
+        blob_ids = []
+        if task.blobs_dir is not None:
+            blobs = BlobStore(task.blobs_dir)
+            blob_ids = [blobs.adopt(output) for output in outputs]
+        return task.index, (outputs, blob_ids), None
+    except Exception as e:
+        return task.index, None, f'{type(e).__name__}: {e}'
+
+
+class FileTask(NamedTuple):
+    index: int  # индекс файла в списке этапа
+    func: Callable  # функция модуля (передается в дочерний процесс)
+    file: str
+    args: tuple
+
+
+def _run_file_task(task):
+    try:
+        return task.index, task.func(task.file, *task.args), None
+    except Exception as e:
+        return task.index, None, f'{type(e).__name__}: {e}'
+
+
+def run_tasks(tasks, workers=None, progress=None, is_cancelled=None, func=_run_task):
+    """
+    Выполняет задачи и возвращает словарь {индекс: (результат или None, ошибка или None)}.
+    Результат задачи StepTask - (созданные файлы, их хэши).
+
+    :param workers: Число процессов; None - по числу ядер, 1 - без пула
+    :param progress: Функция progress(обработано, всего), вызывается после каждого файла
+    :param is_cancelled: Функция без аргументов; если вернула True, обработка
+        прерывается и возвращается None
+    :param func: Функция задачи, возвращающая (индекс, результат, ошибка),
+        например создание иконок
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks)))
+    results = dict()
+    if workers == 1:
+        for task in tasks:
+            if is_cancelled is not None and is_cancelled():
+                return None
+            index, result, error = func(task)
+            results[index] = (result, error)
+            if progress is not None:
+                progress(len(results), len(tasks))
+        return results
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = {executor.submit(func, task): task.index for task in tasks}
+        for future in as_completed(futures):
+            if is_cancelled is not None and is_cancelled():
+                executor.shutdown(wait=True, cancel_futures=True)
+                return None
+            try:
+                index, result, error = future.result()
+            except Exception:
+                # Процесс завершился аварийно - ошибка относится к конкретному файлу
+                index, result, error = futures[future], None, traceback.format_exc(limit=1)
+            results[index] = (result, error)
+            if progress is not None:
+                progress(len(results), len(tasks))
+    finally:
+        executor.shutdown(wait=True)
+    return results
+
+
+def map_files(func, files, *args, workers=None, progress=None, is_cancelled=None):
+    """
+    Вызывает func(файл, *args) для каждого файла в пуле процессов (см. run_tasks).
+
+    :param func: Функция уровня модуля, чтобы ее можно было передать дочернему процессу
+    :param files: Словарь {индекс: файл}
+    :return: Словарь {индекс: (результат или None, ошибка или None)}; None при отмене
+    """
+    tasks = [FileTask(i, func, file, args) for i, file in files.items()]
+    if not tasks:
+        return dict()
+    return run_tasks(tasks, workers, progress, is_cancelled, func=_run_file_task)
@@ -0,0 +1,220 @@
+'''Многоуровневое (пирамидальное) представление скана для окна просмотра.
+
+Уровень k - изображение, уменьшенное в 2**k раз. Уровни строятся по требованию:
+JPEG сразу декодируется в нужном масштабе (draft, до 1/8), остальные уровни
+получаются уменьшением ближайшего более подробного уровня. Каждый уровень
+разбит на плитки, в QPixmap преобразуются только видимые плитки.
+Пирамиды последних открытых файлов хранятся, поэтому возврат к листу
+не требует повторного декодирования, а соседние файлы можно декодировать
+заранее в фоне (prefetch).
+'''
+import math
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+from PyQt6.QtCore import QRectF, QRunnable, QSize, Qt, QThreadPool
+from PyQt6.QtGui import QPainter
+from PyQt6.QtWidgets import QGraphicsItem
+
+import imagecache
+import vimage
+from functions import pil2pixmap
+
+TILE_SIZE = 512
+MAX_TILES = 256  # плиток в одной пирамиде
+MAX_PYRAMIDS = 8
+MAX_DRAFT_LEVEL = 3  # JPEG декодируется с уменьшением не более чем в 8 раз
+
+
+class ImagePyramid:
+    def __init__(self, image=None, path=None):
+        """
+        :param image: Изображение PIL, уже загруженное в память
+        :param path: Файл изображения; уровни декодируются из него по требованию
+        """
+        self.path = path
+        self.lock = threading.Lock()  # уровни может строить и фоновая предзагрузка
+        self.levels = dict()  # {уровень: изображение PIL}
+        self.tiles = OrderedDict()  # {(уровень, столбец, строка): QPixmap}
+        if image is not None:
+            self.levels[0] = image
+            self.size = image.size
+        else:
+            self.size = tuple(imagecache.image_size(path))
+        self.max_level = 0
+        while max(self.size) >> (self.max_level + 1) >= TILE_SIZE // 2:
+            self.max_level += 1
+
+    def level_for(self, scale):
+        """Самый мелкий уровень, подробности которого хватает для масштаба scale (экран/оригинал)."""
+        if scale <= 0:
+            return self.max_level
+        return max(0, min(self.max_level, int(math.floor(math.log2(1 / scale)))))
+
+    def _draft(self, level):
+        """Уровень прямо из JPEG, уменьшенный при декодировании, или None."""
+        if self.path is None or vimage.is_virtual(self.path) or level == 0:
+            return None
+        image = Image.open(self.path)
+        if image.format != 'JPEG':
+            return None
+        scale = 2 ** min(level, MAX_DRAFT_LEVEL)
+        image.draft(image.mode if image.mode in ('L', 'RGB') else None,
+                    (math.ceil(self.size[0] / scale), math.ceil(self.size[1] / scale)))
+        image.load()
+        return image
+
+    def level(self, level):
+        image = self.levels.get(level)
+        if image is not None:
+            return image
+        with self.lock:
+            return self._build_level(level)
+
+    def _build_level(self, level):
+        image = self.levels.get(level)
+        if image is not None:
+            return image
+        finer = [k for k in self.levels if k < level]
+        if not finer:
+            image = self._draft(level)
+            if image is None:
+                image = imagecache.open_image(self.path)
+        else:
+            image = self.levels[max(finer)]
+        # Недостающие множители 2 добираются уменьшением
+        factor = round(self.size[0] / image.width) if image.width else 1
+        while factor < 2 ** level:
+            image = image.reduce(2)
+            factor *= 2
+            self.levels[int(math.log2(factor))] = image
+        self.levels[level] = image
+        return image
+
+    def level_size(self, level):
+        return self.level(level).size
+
+    def tile(self, level, column, row):
+        key = (level, column, row)
+        pixmap = self.tiles.get(key)
+        if pixmap is not None:
+            self.tiles.move_to_end(key)
+            return pixmap
+        image = self.level(level)
+        box = (column * TILE_SIZE, row * TILE_SIZE,
+               min((column + 1) * TILE_SIZE, image.width), min((row + 1) * TILE_SIZE, image.height))
+        pixmap = pil2pixmap(image.crop(box))
+        self.tiles[key] = pixmap
+        while len(self.tiles) > MAX_TILES:
+            self.tiles.popitem(last=False)
+        return pixmap
+
+
+_pyramids = OrderedDict()  # {путь: (отметка файла, пирамида)}
+_lock = threading.Lock()
+
+
+def get_pyramid(path):
+    """Пирамида файла; пирамиды последних файлов переиспользуются, пока файл не изменился."""
+    path = os.path.abspath(path)
+    stamp = imagecache.file_stamp(path)
+    with _lock:
+        # Пирамида создается под блокировкой (читается только заголовок файла),
+        # чтобы окно и фоновая предзагрузка получили один и тот же объект
+        entry = _pyramids.get(path)
+        if entry is not None and entry[0] == stamp:
+            _pyramids.move_to_end(path)
+            return entry[1]
+        pyramid = ImagePyramid(path=path)
+        _pyramids[path] = (stamp, pyramid)
+        _pyramids.move_to_end(path)
+        while len(_pyramids) > MAX_PYRAMIDS:
+            _pyramids.popitem(last=False)
+    return pyramid
+
+
+def fit_size(size, container_size):
+    """Размер изображения size, вписанного в container_size с сохранением пропорций."""
+    return QSize(*size).scaled(QSize(*container_size), Qt.AspectRatioMode.KeepAspectRatio)
+
+
+class _PrefetchTask(QRunnable):
+    def __init__(self, path, container_size):
+        super().__init__()
+        self.path = path
+        self.container_size = container_size
+
+    def run(self):
+        # Строится только уровень PIL: QPixmap плиток создаются при отрисовке в потоке интерфейса
+        try:
+            pyramid = get_pyramid(self.path)
+            display_size = fit_size(pyramid.size, self.container_size)
+            if display_size.width() > 0:
+                pyramid.level(pyramid.level_for(display_size.width() / pyramid.size[0]))
+        except OSError:
+            pass
+
+
+_prefetch_pool = None
+
+
+def prefetch(paths, container_size):
+    """Заранее декодирует в фоне уровни пирамид файлов paths, нужные для окна размера container_size."""
+    global _prefetch_pool
+    if _prefetch_pool is None:
+        _prefetch_pool = QThreadPool()
+        _prefetch_pool.setMaxThreadCount(2)
+    _prefetch_pool.clear()
+    for path in paths:
+        _prefetch_pool.start(_PrefetchTask(path, container_size))
+
+
+class TiledImageItem(QGraphicsItem):
+    """
+    Изображение пирамиды размером display_size в координатах сцены. При отрисовке
+    выбирается уровень по текущему масштабу вида и рисуются только видимые плитки.
+    """
+
+    def __init__(self, pyramid, display_size, parent=None):
+        super().__init__(parent)
+        self.pyramid = pyramid
+        self.display_size = display_size
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+
+    def width(self):
+        return self.display_size.width()
+
+    def height(self):
+        return self.display_size.height()
+
+    def set_display_size(self, display_size):
+        self.prepareGeometryChange()
+        self.display_size = display_size
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.width(), self.height())
+
+    def paint(self, painter, option, widget=None):
+        if self.width() <= 0 or self.height() <= 0:
+            return
+        transform = painter.worldTransform()
+        device_scale = math.hypot(transform.m11(), transform.m12())
+        scale = self.width() / self.pyramid.size[0] * device_scale
+        level = self.pyramid.level_for(scale)
+        level_width, level_height = self.pyramid.level_size(level)
+        fx = level_width / self.width()
+        fy = level_height / self.height()
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        first_column = max(0, int(exposed.left() * fx) // TILE_SIZE)
+        last_column = min((level_width - 1) // TILE_SIZE, int(exposed.right() * fx) // TILE_SIZE)
+        first_row = max(0, int(exposed.top() * fy) // TILE_SIZE)
+        last_row = min((level_height - 1) // TILE_SIZE, int(exposed.bottom() * fy) // TILE_SIZE)
+        painter.setRenderHint(QPainter.RenderHint.SmoothPixmapTransform)
+        for row in range(first_row, last_row + 1):
+            for column in range(first_column, last_column + 1):
+                pixmap = self.pyramid.tile(level, column, row)
+                target = QRectF(column * TILE_SIZE / fx, row * TILE_SIZE / fy,
+                                pixmap.width() / fx, pixmap.height() / fy)
+                painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
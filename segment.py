@@ -0,0 +1,64 @@
+'''Выделение букв в изображениях слов (этап letter_select).
+
+Изображение слова переводится в черно-белое (порог Оцу, адаптивный или
+заданный числом), мелкие разрывы штрихов закрываются, буквы - связные
+области, размеры которых укладываются в пределы проекта. Все области
+находятся одним вызовом connectedComponentsWithStats и отбираются
+по размерам сразу для всего массива.
+'''
+from typing import NamedTuple, Union
+
+import cv2
+import numpy as np
+
+import vimage
+
+
+class LetterLimits(NamedTuple):
+    min_width: int = 50
+    max_width: int = 100
+    min_height: int = 60
+    max_height: int = 170
+    threshold: Union[str, int] = 'otsu'  # 'otsu', 'adaptive' или порог яркости 0-255
+
+
+DEFAULT_LIMITS = LetterLimits()
+ADAPTIVE_BLOCK = 51  # окно адаптивного порога, пикселей
+ADAPTIVE_C = 15
+
+
+def binarize(gray, threshold='otsu'):
+    """Маска чернил (255 - чернила) изображения в оттенках серого."""
+    if threshold == 'otsu':
+        _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    elif threshold == 'adaptive':
+        mask = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV,
+                                     ADAPTIVE_BLOCK, ADAPTIVE_C)
+    else:
+        _, mask = cv2.threshold(gray, int(threshold), 255, cv2.THRESH_BINARY_INV)
+    return mask
+
+
+def segment(gray, limits=DEFAULT_LIMITS):
+    """
+    Прямоугольники букв слова слева направо.
+
+    :param gray: Изображение в оттенках серого (массив uint8)
+    :return: Кортеж (x, y, ширина, высота)
+    """
+    mask = binarize(gray, limits.threshold)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+    # Нулевая компонента - фон
+    w, h = stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT]
+    keep = ((w >= limits.min_width) & (w <= limits.max_width) &
+            (h >= limits.min_height) & (h <= limits.max_height))
+    boxes = stats[1:, :4][keep]
+    boxes = boxes[np.argsort(boxes[:, 0], kind='stable')]
+    return tuple(tuple(int(v) for v in box) for box in boxes)
+
+
+def segment_file(file, limits=DEFAULT_LIMITS):
+    """Прямоугольники букв файла (обычного или .vimg)."""
+    return segment(np.asarray(vimage.open_image(file).convert('L')), limits)
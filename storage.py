@@ -0,0 +1,289 @@
+'''Хранение проекта в базе SQLite.
+
+Каждое действие оператора записывается отдельной строкой, поэтому сохранение
+не зависит от размера проекта, а сбой во время записи не портит весь проект.
+'''
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS project_info (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    curr_step INTEGER,
+    check_list TEXT
+);
+CREATE TABLE IF NOT EXISTS step_info (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    step INTEGER,
+    file_name TEXT,
+    oper_str TEXT,
+    UNIQUE (step, file_name)
+);
+CREATE TABLE IF NOT EXISTS source_files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    full_path TEXT,
+    base_name TEXT UNIQUE
+);
+CREATE TABLE IF NOT EXISTS res_files (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    source_file INTEGER REFERENCES source_files (id),
+    step INTEGER,
+    file_name TEXT,
+    oper_str TEXT,
+    res_name TEXT,
+    UNIQUE (step, res_name)
+);
+CREATE INDEX IF NOT EXISTS res_files_source ON res_files (source_file);
+CREATE INDEX IF NOT EXISTS res_files_input ON res_files (step, file_name);
+CREATE TABLE IF NOT EXISTS images (
+    step INTEGER,
+    file_name TEXT,
+    blob TEXT,
+    PRIMARY KEY (step, file_name)
+);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    step INTEGER,
+    file_name TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    digest TEXT,
+    oper_str TEXT,
+    outputs TEXT,
+    PRIMARY KEY (step, file_name)
+);
+CREATE TABLE IF NOT EXISTS thumbnails (
+    step INTEGER,
+    file_name TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    cache_key TEXT,
+    PRIMARY KEY (step, file_name)
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def to_tuple(value):
+    """JSON не различает списки и кортежи - значения действий восстанавливаются кортежами."""
+    if isinstance(value, list):
+        return tuple(to_tuple(v) for v in value)
+    return value
+
+
+class ProjectStore:
+    def __init__(self, db_name):
+        self.db_name = db_name
+        # Проект сохраняется и из потока перехода на следующий этап
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.conn = sqlite3.connect(db_name, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция; вложенные вызовы выполняются в рамках внешней транзакции."""
+        with self.lock:
+            self.depth += 1
+            try:
+                if self.depth > 1:
+                    yield self.conn
+                else:
+                    with self.conn:
+                        yield self.conn
+            finally:
+                self.depth -= 1
+
+    def load_info(self):
+        with self.lock:
+            row = self.conn.execute("SELECT path, curr_step, check_list FROM project_info "
+                                    "WHERE id = 1").fetchone()
+        if row is None:
+            return None
+        path, step, check_list = row
+        return path, step, None if check_list is None else json.loads(check_list)
+
+    def save_info(self, path, step, check_list):
+        with self.transaction() as conn:
+            conn.execute("INSERT INTO project_info (id, path, curr_step, check_list) VALUES (1, ?, ?, ?) "
+                         "ON CONFLICT(id) DO UPDATE SET path = excluded.path, "
+                         "curr_step = excluded.curr_step, check_list = excluded.check_list",
+                         (path, step, None if check_list is None else json.dumps(check_list)))
+
+    def get_setting(self, name, default=None):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM settings WHERE name = ?", (name,)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def set_setting(self, name, value):
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)",
+                         (name, json.dumps(value)))
+
+    def load_actions(self, step):
+        """Действия этапа: {имя файла: (тип, значение, final)}."""
+        with self.lock:
+            rows = self.conn.execute("SELECT file_name, oper_str FROM step_info WHERE step = ?",
+                                     (step,)).fetchall()
+        return {name: to_tuple(json.loads(oper_str)) for name, oper_str in rows}
+
+    def save_action(self, step, file_name, action):
+        """Записывает действие над файлом этапа; None удаляет действие."""
+        with self.transaction() as conn:
+            if action is None:
+                conn.execute("DELETE FROM step_info WHERE step = ? AND file_name = ?", (step, file_name))
+            else:
+                conn.execute("INSERT INTO step_info (step, file_name, oper_str) VALUES (?, ?, ?) "
+                             "ON CONFLICT(step, file_name) DO UPDATE SET oper_str = excluded.oper_str",
+                             (step, file_name, json.dumps(list(action))))
+
+    def load_fingerprints(self):
+        """{этап: {имя файла: ((размер, время изменения), хэш, действие, [имена результатов])}}"""
+        with self.lock:
+            rows = self.conn.execute("SELECT step, file_name, size, mtime_ns, digest, oper_str, outputs "
+                                     "FROM fingerprints").fetchall()
+        fingerprints = dict()
+        for step, name, size, mtime_ns, digest, oper_str, outputs in rows:
+            fingerprints.setdefault(step, dict())[name] = ((size, mtime_ns), digest,
+                                                           to_tuple(json.loads(oper_str)),
+                                                           json.loads(outputs))
+        return fingerprints
+
+    def save_fingerprints(self, step, entries):
+        """Полностью заменяет отпечатки файлов этапа step."""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM fingerprints WHERE step = ?", (step,))
+            conn.executemany("INSERT INTO fingerprints (step, file_name, size, mtime_ns, digest, oper_str, outputs) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             [(step, name, stat[0], stat[1], digest, json.dumps(action_key), json.dumps(outputs))
+                              for name, (stat, digest, action_key, outputs) in entries.items()])
+
+    def load_thumbnail_keys(self, step):
+        """Иконки этапа: {имя файла: ((размер, время изменения), ключ иконки в кэше)}."""
+        with self.lock:
+            rows = self.conn.execute("SELECT file_name, size, mtime_ns, cache_key FROM thumbnails "
+                                     "WHERE step = ?", (step,)).fetchall()
+        return {name: ((size, mtime_ns), key) for name, size, mtime_ns, key in rows}
+
+    def save_thumbnail_keys(self, step, entries):
+        """Полностью заменяет сведения об иконках этапа step."""
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM thumbnails WHERE step = ?", (step,))
+            conn.executemany("INSERT INTO thumbnails (step, file_name, size, mtime_ns, cache_key) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             [(step, name, stat[0], stat[1], key) for name, (stat, key) in entries.items()])
+
+    # Происхождение файлов: строка res_files означает, что файл file_name этапа step
+    # после операции oper_str дал файл res_name этапа step + 1, а source_file - исходный скан
+
+    def add_sources(self, paths):
+        with self.transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO source_files (full_path, base_name) VALUES (?, ?)",
+                             [(path, os.path.basename(path)) for path in paths])
+
+    def has_lineage(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM res_files LIMIT 1").fetchone() is not None
+
+    def record_results(self, step, file_name, action_key, res_names, blob_ids=()):
+        """
+        Записывает результаты обработки файла этапа step вместо прежних.
+
+        :param blob_ids: Хэши результатов в хранилище изображений
+        """
+        with self.transaction() as conn:
+            if step == 0:
+                row = conn.execute("SELECT id FROM source_files WHERE base_name = ?", (file_name,)).fetchone()
+            else:
+                row = conn.execute("SELECT source_file FROM res_files WHERE step = ? AND res_name = ?",
+                                   (step - 1, file_name)).fetchone()
+            source_id = None if row is None else row[0]
+            conn.execute("DELETE FROM res_files WHERE step = ? AND file_name = ?", (step, file_name))
+            conn.executemany("INSERT OR REPLACE INTO res_files (source_file, step, file_name, oper_str, res_name) "
+                             "VALUES (?, ?, ?, ?, ?)",
+                             [(source_id, step, file_name, json.dumps(action_key), res_name)
+                              for res_name in res_names])
+            conn.executemany("INSERT OR REPLACE INTO images (step, file_name, blob) VALUES (?, ?, ?)",
+                             [(step + 1, res_name, blob_id) for res_name, blob_id in zip(res_names, blob_ids)])
+
+    def derived_files(self, step, names):
+        """Все файлы следующих этапов, полученные из файлов names этапа step: {(этап, имя)}."""
+        with self.transaction() as conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS lookup_names (name TEXT PRIMARY KEY)")
+            conn.execute("DELETE FROM lookup_names")
+            conn.executemany("INSERT OR IGNORE INTO lookup_names (name) VALUES (?)",
+                             [(name,) for name in names])
+            rows = conn.execute("""
+                WITH RECURSIVE derived(step, name) AS (
+                    SELECT r.step + 1, r.res_name FROM res_files r
+                    JOIN lookup_names l ON r.file_name = l.name WHERE r.step = ?
+                    UNION
+                    SELECT r.step + 1, r.res_name FROM res_files r
+                    JOIN derived d ON r.step = d.step AND r.file_name = d.name
+                )
+                SELECT step, name FROM derived""", (step,)).fetchall()
+            conn.execute("DELETE FROM lookup_names")
+        return set(rows)
+
+    def forget_files(self, files):
+        """Удаляет сведения о происхождении файлов {(этап, имя)} и о полученных из них файлах."""
+        with self.transaction() as conn:
+            conn.executemany("DELETE FROM res_files WHERE step = ? AND res_name = ?",
+                             [(step - 1, name) for step, name in files])
+            conn.executemany("DELETE FROM res_files WHERE step = ? AND file_name = ?",
+                             list(files))
+            conn.executemany("DELETE FROM images WHERE step = ? AND file_name = ?",
+                             list(files))
+            conn.executemany("DELETE FROM thumbnails WHERE step = ? AND file_name = ?",
+                             list(files))
+
+    def image_id(self, step, file_name):
+        """Хэш изображения файла этапа в хранилище или None."""
+        with self.lock:
+            row = self.conn.execute("SELECT blob FROM images WHERE step = ? AND file_name = ?",
+                                    (step, file_name)).fetchone()
+        return None if row is None else row[0]
+
+    def dependent_files(self, source_name):
+        """Все файлы, полученные из исходного скана: [(этап, имя, операция)]."""
+        with self.lock:
+            rows = self.conn.execute("SELECT r.step + 1, r.res_name, r.oper_str FROM res_files r "
+                                     "JOIN source_files s ON r.source_file = s.id "
+                                     "WHERE s.base_name = ? ORDER BY r.step, r.res_name",
+                                     (source_name,)).fetchall()
+        return [(step, name, to_tuple(json.loads(oper_str))) for step, name, oper_str in rows]
+
+    def trace(self, step, name):
+        """Цепочка от исходного скана до файла: [(этап, входной файл, операция, результат)]."""
+        with self.lock:
+            rows = self.conn.execute("""
+                WITH RECURSIVE chain(step, file_name, oper_str, res_name) AS (
+                    SELECT step, file_name, oper_str, res_name FROM res_files
+                    WHERE step = ? AND res_name = ?
+                    UNION ALL
+                    SELECT r.step, r.file_name, r.oper_str, r.res_name FROM res_files r
+                    JOIN chain c ON r.step = c.step - 1 AND r.res_name = c.file_name
+                )
+                SELECT step, file_name, oper_str, res_name FROM chain ORDER BY step""",
+                                     (step - 1, name)).fetchall()
+        return [(s, file_name, to_tuple(json.loads(oper_str)), res_name)
+                for s, file_name, oper_str, res_name in rows]
+
+    def source_path(self, name):
+        with self.lock:
+            row = self.conn.execute("SELECT full_path FROM source_files WHERE base_name = ?",
+                                    (name,)).fetchone()
+        return None if row is None else row[0]
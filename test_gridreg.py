@@ -0,0 +1,63 @@
+"""Проверка привязки сетки по меткам на листе, размеченном как бланк."""
+import numpy as np
+from PIL import Image, ImageDraw
+
+import gridreg
+from layout import IMAGE_PARTS, MARKERS
+
+MARKER_SIDE = 40
+
+
+def sample_sheet(path, origin, scale=1.0, skip=()):
+    """
+    Лист с сеткой слов, начинающейся в origin: светлые рамки областей слов,
+    темные строки текста в них и черные квадраты-метки (кроме номеров из skip).
+    """
+    x0, y0 = origin
+    image = Image.new('L', (4000, 2800), 235)
+    draw = ImageDraw.Draw(image)
+
+    def point(x, y):
+        return x0 + x * scale, y0 + y * scale
+
+    for x1, y1, x2, y2 in IMAGE_PARTS:
+        draw.rectangle(point(x1, y1) + point(x2, y2), outline=170, width=3)
+        # Строка "текста" отступает от рамки, чтобы не касаться меток
+        for x in range(x1 + 40, x2 - 60, 90):
+            draw.line(point(x, y1 + 50) + point(x + 50, y2 - 40), fill=30, width=6)
+    for k, (x, y) in enumerate(MARKERS):
+        if k not in skip:
+            cx, cy = point(x, y)
+            draw.rectangle((cx - MARKER_SIDE / 2, cy - MARKER_SIDE / 2,
+                            cx + MARKER_SIDE / 2, cy + MARKER_SIDE / 2), fill=0)
+    image.save(path, quality=90)
+    return path
+
+
+def test_markers_found_on_sample_sheet(tmp_path):
+    sheet = sample_sheet(tmp_path / 'sheet.jpg', (300, 400))
+    gray = np.asarray(Image.open(sheet).convert('L'))
+    markers = gridreg.find_markers(gray)
+    assert len(markers) == len(MARKERS)
+
+
+def test_grid_origin_on_sample_sheet(tmp_path):
+    sheet = sample_sheet(tmp_path / 'sheet.jpg', (300, 400))
+    (x, y), scale, angle, confidence = gridreg.register_file(str(sheet))
+    assert abs(x - 300) <= 2 and abs(y - 400) <= 2
+    assert abs(scale - 1) < 0.01 and abs(angle) < 0.5
+    assert confidence >= gridreg.MIN_CONFIDENCE
+
+
+def test_grid_origin_with_missing_marker(tmp_path):
+    # Одна метка закрыта (например, скрепкой), начало сетки находится по остальным
+    sheet = sample_sheet(tmp_path / 'sheet.jpg', (250, 350), scale=1.01, skip=(0,))
+    (x, y), scale, _, confidence = gridreg.register_file(str(sheet))
+    assert abs(x - 250) <= 3 and abs(y - 350) <= 3
+    assert abs(scale - 1.01) < 0.005
+    assert confidence >= gridreg.MIN_CONFIDENCE
+
+
+def test_no_grid_without_markers(tmp_path):
+    sheet = sample_sheet(tmp_path / 'sheet.jpg', (300, 400), skip=range(len(MARKERS)))
+    assert gridreg.register_file(str(sheet)) is None
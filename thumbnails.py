@@ -0,0 +1,60 @@
+'''Создание иконок файлов этапа, в том числе в пуле процессов.
+
+Иконки хранятся в processing/thumbcache/<2 символа>/<хэш файла>_<ширина>x<высота>.jpg,
+а в папках thumbnails этапов лежат жесткие ссылки на них. Файл, перешедший на
+следующий этап без изменений, получает готовую иконку без повторного декодирования.
+'''
+import os
+from typing import NamedTuple
+
+import vimage
+from blobstore import link_file
+
+THUMBNAIL_SIZE = (400, 400)
+
+
+class ThumbnailTask(NamedTuple):
+    index: int  # индекс файла в списке этапа
+    file: str
+    cache_file: str  # иконка в общем кэше
+    dest: str  # иконка в папке этапа
+
+
+def cache_key(digest, size=THUMBNAIL_SIZE):
+    return f'{digest}_{size[0]}x{size[1]}'
+
+
+def cache_name(cache_dir, key):
+    return cache_dir + '/' + key[:2] + '/' + key + '.jpg'
+
+
+def make_thumbnail(file, dest, size=THUMBNAIL_SIZE):
+    """Создает иконку файла (обычного или .vimg) не больше size."""
+    if vimage.is_virtual(file):
+        # Описание сразу отрисовывается в размере иконки, полное изображение не собирается
+        image = vimage.open_reduced(file, max(size))
+    else:
+        image = vimage.open_image(file)
+        if image.format == 'JPEG':
+            # JPEG уменьшается еще при декодировании (в области DCT), полный размер не распаковывается
+            image.draft('RGB', size)
+    image.thumbnail(size)
+    image = image.convert('RGB')
+    if os.path.lexists(dest):
+        os.remove(dest)
+    image.save(dest, format='JPEG')
+
+
+def run_thumbnail_task(task):
+    try:
+        if not os.path.isfile(task.cache_file):
+            os.makedirs(os.path.dirname(task.cache_file), exist_ok=True)
+            # Иконка пишется во временный файл: параллельная задача с тем же хэшем
+            # не должна увидеть недописанный файл
+            temp_file = f'{task.cache_file}.{os.getpid()}.tmp'
+            make_thumbnail(task.file, temp_file)
+            os.replace(temp_file, task.cache_file)
+        link_file(task.cache_file, task.dest)
+        return task.index, task.dest, None
+    except Exception as e:
+        return task.index, None, f'{type(e).__name__}: {e}'
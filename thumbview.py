@@ -0,0 +1,214 @@
+'''Список иконок этапа: модель, отрисовка и фоновая загрузка иконок.
+
+Виджеты для строк не создаются: QListView запрашивает у модели только видимые
+строки, иконки читаются в пуле потоков и хранятся в ограниченном кэше.
+Отметки файлов и строки, требующие проверки, хранятся в модели.
+'''
+from collections import OrderedDict
+
+from PyQt6.QtCore import (QAbstractListModel, QModelIndex, QObject, QRunnable, QSize, Qt,
+                          QThreadPool, pyqtSignal)
+from PyQt6.QtGui import QImage, QImageReader, QPen, QPixmap
+from PyQt6.QtWidgets import QListView, QStyle, QStyledItemDelegate
+
+ICON_SIZE = QSize(200, 400)
+PIXMAP_CACHE_SIZE = 500
+
+
+def fit_size(size, bounds=ICON_SIZE):
+    """Размер size, уменьшенный с сохранением пропорций до bounds."""
+    if size.isEmpty():
+        return QSize(bounds.width(), bounds.width())
+    return size.scaled(bounds, Qt.AspectRatioMode.KeepAspectRatio)
+
+
+class _LoadTask(QRunnable):
+    def __init__(self, loader, path, size):
+        super().__init__()
+        self.loader = loader
+        self.path = path
+        self.size = size
+
+    def run(self):
+        # QImage можно создавать вне потока интерфейса, QPixmap - нельзя
+        image = QImage(self.path)
+        if not image.isNull():
+            image = image.scaled(self.size, Qt.AspectRatioMode.KeepAspectRatio,
+                                 Qt.TransformationMode.SmoothTransformation)
+        self.loader.loaded.emit(self.path, image)
+
+
+class PixmapLoader(QObject):
+    """Читает иконки в пуле потоков; последние запросы (видимые строки) выполняются первыми."""
+    loaded = pyqtSignal(str, QImage)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(2)
+        self.pending = set()
+        self.priority = 0
+        self.loaded.connect(self._done)
+
+    def request(self, path, size):
+        if path in self.pending:
+            return
+        self.pending.add(path)
+        self.priority += 1
+        self.pool.start(_LoadTask(self, path, size), self.priority)
+
+    def _done(self, path, image):
+        self.pending.discard(path)
+
+    def clear(self):
+        self.pool.clear()
+        self.pending.clear()
+
+
+class ThumbnailModel(QAbstractListModel):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.thumbnails = []
+        self.checked = []
+        self.rows = dict()  # {путь к иконке: строка}
+        self.flagged = set()  # строки, требующие проверки оператором
+        self.icon_size = ICON_SIZE
+        self.placeholder = QPixmap()
+        self.pixmaps = OrderedDict()  # {путь к иконке: QPixmap}, последние использованные в конце
+        self.loader = PixmapLoader(self)
+        self.loader.loaded.connect(self.pixmap_loaded)
+
+    def set_thumbnails(self, thumbnails, checked=None):
+        """Заменяет список иконок; отметки берутся из checked (по умолчанию не отмечены)."""
+        self.beginResetModel()
+        self.loader.clear()
+        self.pixmaps.clear()
+        self.flagged = set()
+        self.thumbnails = list(thumbnails)
+        self.rows = {path: row for row, path in enumerate(self.thumbnails)}
+        checked = list(checked or [])
+        self.checked = [bool(checked[i]) if i < len(checked) else False for i in range(len(self.thumbnails))]
+        # Все иконки этапа одного вида, поэтому размер строки определяется по заголовку первой
+        if self.thumbnails:
+            self.icon_size = fit_size(QImageReader(self.thumbnails[0]).size())
+        else:
+            self.icon_size = ICON_SIZE
+        self.placeholder = QPixmap(self.icon_size)
+        self.placeholder.fill(Qt.GlobalColor.transparent)
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.thumbnails)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = index.row()
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f'{row + 1}: ?' if row in self.flagged else f'{row + 1}:'
+        elif role == Qt.ItemDataRole.CheckStateRole:
+            return Qt.CheckState.Checked if self.checked[row] else Qt.CheckState.Unchecked
+        elif role == Qt.ItemDataRole.DecorationRole:
+            path = self.thumbnails[row]
+            pixmap = self.pixmaps.get(path)
+            if pixmap is not None:
+                self.pixmaps.move_to_end(path)
+                return pixmap
+            # Вид запрашивает только видимые строки - только они и загружаются
+            self.loader.request(path, self.icon_size)
+            return self.placeholder
+        return None
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if index.isValid() and role == Qt.ItemDataRole.CheckStateRole:
+            self.checked[index.row()] = Qt.CheckState(value) == Qt.CheckState.Checked
+            self.dataChanged.emit(index, index, [role])
+            return True
+        return False
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+        return Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsUserCheckable
+
+    def _store(self, path, pixmap):
+        self.pixmaps[path] = pixmap
+        self.pixmaps.move_to_end(path)
+        while len(self.pixmaps) > PIXMAP_CACHE_SIZE:
+            self.pixmaps.popitem(last=False)
+
+    def pixmap_loaded(self, path, image):
+        row = self.rows.get(path)
+        if row is None or image.isNull():
+            return
+        self._store(path, QPixmap.fromImage(image))
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.DecorationRole])
+
+    def set_pixmap(self, row, pixmap):
+        """Заменяет иконку строки (например, после рисования на ней действия)."""
+        self._store(self.thumbnails[row], pixmap.scaled(self.icon_size, Qt.AspectRatioMode.KeepAspectRatio,
+                                                        Qt.TransformationMode.SmoothTransformation))
+        index = self.index(row)
+        self.dataChanged.emit(index, index, [Qt.ItemDataRole.DecorationRole])
+
+    def set_flagged(self, rows):
+        """Отмечает строки, требующие проверки (например, разрез найден неуверенно)."""
+        changed = self.flagged.symmetric_difference(rows)
+        self.flagged = set(rows)
+        for row in changed:
+            index = self.index(row)
+            self.dataChanged.emit(index, index, [Qt.ItemDataRole.DisplayRole])
+
+    def unflag(self, rows):
+        """Снимает отметку проверки со строк, действия которых подтвердил оператор."""
+        self.set_flagged(self.flagged.difference(rows))
+
+    def get_check_list(self):
+        return list(self.checked)
+
+    def set_all_checked(self, checked):
+        self.checked = [checked] * len(self.thumbnails)
+        if self.thumbnails:
+            self.dataChanged.emit(self.index(0), self.index(len(self.thumbnails) - 1),
+                                  [Qt.ItemDataRole.CheckStateRole])
+
+
+class ThumbnailDelegate(QStyledItemDelegate):
+    """
+    Строка списка: отметка, иконка и номер; текущая иконка обводится зеленой рамкой,
+    иконка, требующая проверки, - красной.
+    """
+
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        option.decorationSize = index.model().icon_size
+
+    def paint(self, painter, option, index):
+        super().paint(painter, option, index)
+        if option.state & QStyle.StateFlag.State_HasFocus or option.state & QStyle.StateFlag.State_Selected:
+            color = Qt.GlobalColor.green
+        elif index.row() in index.model().flagged:
+            color = Qt.GlobalColor.red
+        else:
+            return
+        painter.save()
+        painter.setPen(QPen(color, 2))
+        painter.drawRect(option.rect.adjusted(1, 1, -1, -1))
+        painter.restore()
+
+    def sizeHint(self, option, index):
+        size = index.model().icon_size
+        return QSize(size.width() + 80, size.height() + 8)
+
+
+class ThumbnailView(QListView):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setModel(ThumbnailModel(self))
+        self.setItemDelegate(ThumbnailDelegate(self))
+        # Все строки одной высоты: виду не нужно измерять каждую строку
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(QListView.LayoutMode.Batched)
+        self.setSelectionMode(QListView.SelectionMode.SingleSelection)
+        self.setVerticalScrollMode(QListView.ScrollMode.ScrollPerPixel)
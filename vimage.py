@@ -0,0 +1,253 @@
+'''Виртуальные изображения промежуточных этапов.
+
+Вместо того чтобы записывать половинки бланка на диск, этап может сохранить
+небольшой файл <имя><расширение>.vimg с описанием: исходный файл и цепочка
+преобразований (вырезание, поворот). Пиксели декодируются только когда
+изображение нужно показать или записать окончательный результат (выбор слов).
+
+Цепочка преобразований сводится к одной аффинной матрице, поэтому каждое
+изображение (и каждое слово бланка) получается из исходного скана за одну
+интерполяцию, без промежуточных поворотов и повторного сжатия JPEG.
+'''
+import json
+import math
+import os
+
+from PIL import Image
+
+VIRTUAL_EXT = '.vimg'
+# Матрица (a, b, c, d, e, f) в формате Image.transform: точка результата (x, y)
+# берется из точки (a * x + b * y + c, d * x + e * y + f) входного изображения
+IDENTITY = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+
+
+def is_virtual(path):
+    return path.endswith(VIRTUAL_EXT)
+
+
+def split_name(path):
+    """Имя файла без пути: (основа, расширение изображения, виртуальный ли файл)."""
+    base = os.path.basename(path)
+    virtual = is_virtual(base)
+    if virtual:
+        base = base[:-len(VIRTUAL_EXT)]
+    stem, ext = os.path.splitext(base)
+    return stem, ext, virtual
+
+
+def target_name(path, virtual):
+    """Имя файла с расширением .vimg для описания и без него для изображения."""
+    if is_virtual(path):
+        path = path[:-len(VIRTUAL_EXT)]
+    return path + VIRTUAL_EXT if virtual else path
+
+
+def processing_dir(path):
+    """Папка processing, относительно которой в описании хранится исходный файл."""
+    return os.path.dirname(os.path.dirname(os.path.abspath(path)))
+
+
+def read_virtual(path):
+    with open(path, 'r', encoding='utf-8') as fp:
+        return json.load(fp)
+
+
+def write_virtual(path, description):
+    if os.path.lexists(path):
+        os.remove(path)
+    with open(path, 'w', encoding='utf-8') as fp:
+        json.dump(description, fp)
+
+
+def rotated_size(size, angle, expand):
+    """Размер изображения после Image.rotate(angle, expand) - та же формула, что в PIL."""
+    w, h = size
+    if not expand:
+        return w, h
+    angle = angle % 360.0
+    if angle in (0, 180):
+        return w, h
+    if angle in (90, 270):
+        return h, w
+    a = -math.radians(angle)
+    cos_a, sin_a = round(math.cos(a), 15), round(math.sin(a), 15)
+    cx, cy = w / 2, h / 2
+    xx = []
+    yy = []
+    for x, y in ((0, 0), (w, 0), (w, h), (0, h)):
+        xx.append(cos_a * (x - cx) + sin_a * (y - cy) + cx)
+        yy.append(-sin_a * (x - cx) + cos_a * (y - cy) + cy)
+    return math.ceil(max(xx)) - math.floor(min(xx)), math.ceil(max(yy)) - math.floor(min(yy))
+
+
+def op_size(size, op):
+    if op[0] == 'crop':
+        left, top, right, bottom = op[1]
+        return right - left, bottom - top
+    elif op[0] == 'rotate':
+        return rotated_size(size, op[1], op[2])
+    raise ValueError(f'Неизвестное преобразование {op[0]}')
+
+
+def op_matrix(size, op):
+    """Матрица преобразования op изображения размера size (та же, что строит PIL)."""
+    if op[0] == 'crop':
+        return 1.0, 0.0, float(op[1][0]), 0.0, 1.0, float(op[1][1])
+    elif op[0] == 'rotate':
+        w, h = size
+        a = -math.radians(op[1])
+        cos_a, sin_a = round(math.cos(a), 15), round(math.sin(a), 15)
+        cx, cy = w / 2, h / 2
+        c = -cos_a * cx - sin_a * cy + cx
+        f = sin_a * cx - cos_a * cy + cy
+        if op[2]:
+            nw, nh = rotated_size(size, op[1], True)
+            dx, dy = -(nw - w) / 2.0, -(nh - h) / 2.0
+            c, f = cos_a * dx + sin_a * dy + c, -sin_a * dx + cos_a * dy + f
+        return cos_a, sin_a, c, -sin_a, cos_a, f
+    raise ValueError(f'Неизвестное преобразование {op[0]}')
+
+
+def multiply(m1, m2):
+    """Матрица последовательного применения: сначала m2 к точке результата, затем m1."""
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (a1 * a2 + b1 * d2, a1 * b2 + b1 * e2, a1 * c2 + b1 * f2 + c1,
+            d1 * a2 + e1 * d2, d1 * b2 + e1 * e2, d1 * c2 + e1 * f2 + f1)
+
+
+def fuse(size, ops):
+    """
+    Сводит цепочку ops к одному вырезанию и одной матрице.
+
+    Начальные вырезания (разрезы бланка) объединяются в прямоугольник исходного
+    изображения: за его пределами, как и при поэтапной обработке, будет черный фон.
+
+    :return: Прямоугольник исходного изображения или None, матрица, размер результата
+    """
+    rect = None
+    i = 0
+    while i < len(ops) and ops[i][0] == 'crop':
+        left, top, right, bottom = ops[i][1]
+        if rect is not None:
+            left, top, right, bottom = left + rect[0], top + rect[1], right + rect[0], bottom + rect[1]
+        rect = (left, top, right, bottom)
+        size = (right - left, bottom - top)
+        i += 1
+    matrix = IDENTITY
+    for op in ops[i:]:
+        matrix = multiply(matrix, op_matrix(size, op))
+        size = op_size(size, op)
+    return rect, matrix, size
+
+
+def derive(file, *ops):
+    """Описание изображения, полученного из файла file (обычного или виртуального) преобразованиями ops."""
+    if is_virtual(file):
+        description = read_virtual(file)
+        description = dict(description, ops=description['ops'] + [list(op) for op in ops])
+        size = description['size']
+    else:
+        with Image.open(file) as image:
+            size = image.size
+        description = {'source': os.path.relpath(os.path.abspath(file), processing_dir(file)).replace('\\', '/'),
+                       'ops': [list(op) for op in ops]}
+    for op in ops:
+        size = op_size(size, op)
+    description['size'] = list(size)
+    return description
+
+
+def source_path(path, description):
+    return os.path.join(processing_dir(path), description['source'])
+
+
+def apply_ops(image, ops):
+    for op in ops:
+        if op[0] == 'crop':
+            image = image.crop(tuple(op[1]))
+        elif op[0] == 'rotate':
+            image = image.rotate(op[1], expand=op[2])
+    return image
+
+
+def prepare(path):
+    """
+    Исходное изображение описания path (с объединенными начальными вырезаниями),
+    матрица остальной цепочки и размер результата.
+    """
+    description = read_virtual(path)
+    image = Image.open(source_path(path, description))
+    rect, matrix, size = fuse(image.size, description['ops'])
+    if rect is not None:
+        image = image.crop(rect)
+    return image, matrix, size
+
+
+def sample(image, matrix, size, box=None, resample=Image.Resampling.BICUBIC):
+    """Результат цепочки (или его область box) за одну выборку из подготовленного изображения."""
+    if box is not None:
+        matrix = multiply(matrix, (1.0, 0.0, box[0], 0.0, 1.0, box[1]))
+        size = (box[2] - box[0], box[3] - box[1])
+    a, b, c, d, e, f = matrix
+    if (a, b, d, e) == (1.0, 0.0, 0.0, 1.0) and c == int(c) and f == int(f):
+        # Только сдвиг - достаточно вырезать область без интерполяции
+        return image.crop((int(c), int(f), int(c) + size[0], int(f) + size[1]))
+    return image.transform(tuple(size), Image.Transform.AFFINE, matrix, resample)
+
+
+def render(path, box=None, resample=Image.Resampling.BICUBIC):
+    """Изображение описания path или его область box, полученные из исходного файла одним преобразованием."""
+    image, matrix, size = prepare(path)
+    return sample(image, matrix, size, box, resample)
+
+
+def open_image(path):
+    """Открывает обычное или виртуальное изображение."""
+    if not is_virtual(path):
+        return Image.open(path)
+    return render(path)
+
+
+def open_reduced(path, max_size):
+    """
+    Изображение (обычное или .vimg), уменьшенное так, чтобы большая сторона была не больше max_size.
+    Описание получается той же единственной выборкой из исходника, что и при render.
+    """
+    if not is_virtual(path):
+        image = Image.open(path)
+        # thumbnail сам вызывает draft, поэтому JPEG декодируется сразу в уменьшенном виде
+        image.thumbnail((max_size, max_size))
+        return image
+    description = read_virtual(path)
+    image = Image.open(source_path(path, description))
+    full_size = image.size
+    rect, matrix, size = fuse(full_size, description['ops'])
+    factor = max(size) / max_size
+    if factor <= 1:
+        return sample(image if rect is None else image.crop(rect), matrix, size)
+    matrix = multiply(matrix, (factor, 0.0, 0.0, 0.0, factor, 0.0))
+    size = (max(1, round(size[0] / factor)), max(1, round(size[1] / factor)))
+    if image.format == 'JPEG' and factor >= 2:
+        # Исходный JPEG декодируется уже уменьшенным (draft), матрица переводится в его координаты
+        scale = 2 ** min(3, int(math.log2(factor)))
+        image.draft(image.mode if image.mode in ('L', 'RGB') else None,
+                    (math.ceil(full_size[0] / scale), math.ceil(full_size[1] / scale)))
+        sx, sy = full_size[0] / image.width, full_size[1] / image.height
+        offset = (0.0, 0.0)
+        if rect is not None:
+            box = (int(rect[0] / sx), int(rect[1] / sy), math.ceil(rect[2] / sx), math.ceil(rect[3] / sy))
+            image = image.crop(box)
+            offset = (rect[0] / sx - box[0], rect[1] / sy - box[1])
+        matrix = multiply((1 / sx, 0.0, offset[0], 0.0, 1 / sy, offset[1]), matrix)
+    elif rect is not None:
+        image = image.crop(rect)
+    return sample(image, matrix, size, resample=Image.Resampling.BILINEAR)
+
+
+def image_size(path):
+    """Размер изображения без декодирования пикселей."""
+    if is_virtual(path):
+        return tuple(read_virtual(path)['size'])
+    with Image.open(path) as image:
+        return image.size
@@ -0,0 +1,130 @@
+'''Фоновые потоки для долгих операций, чтобы не блокировать интерфейс'''
+import queue
+
+from PyQt6.QtCore import QObject, QThread, QTimer, pyqtSignal
+
+AUTOSAVE_DELAY = 1000  # мс; изменения за это время записываются одной транзакцией
+
+
+class StepWorker(QThread):
+    """Переход проекта на следующий этап: обработка файлов и создание иконок."""
+    progress = pyqtSignal(int, int, str)  # обработано, всего, описание
+    step_done = pyqtSignal(bool)  # True - этап применен, False - ошибка или отмена
+
+    def __init__(self, project, workers=None, parent=None):
+        super().__init__(parent)
+        self.project = project
+        self.workers = workers
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def run(self):
+        result = self.project.next_step(workers=self.workers,
+                                        progress=self.progress.emit,
+                                        is_cancelled=self.is_cancelled)
+        self.step_done.emit(bool(result))
+
+
+class ProposalWorker(QThread):
+    """
+    Автоматическая разметка файлов этапа (поиск разрезов, сетки слов и т. п.):
+    метод проекта propose(workers, progress, is_cancelled), возвращающий индексы
+    файлов для проверки или None при отмене.
+    """
+    progress = pyqtSignal(int, int, str)  # обработано, всего, описание
+    proposals_done = pyqtSignal(object)  # индексы файлов с неуверенной оценкой или None при отмене
+
+    def __init__(self, project, propose, text, workers=None, parent=None):
+        super().__init__(parent)
+        self.project = project
+        self.propose = propose
+        self.text = text
+        self.workers = workers
+        self._cancelled = False
+
+    def cancel(self):
+        self._cancelled = True
+
+    def is_cancelled(self):
+        return self._cancelled
+
+    def run(self):
+        def progress(done, total):
+            self.progress.emit(done, total, self.text)
+        review = self.propose(workers=self.workers, progress=progress, is_cancelled=self.is_cancelled)
+        self.proposals_done.emit(review)
+
+
+class SaveWriter(QThread):
+    """Записывает собранные изменения проектов в базу по очереди."""
+    failed = pyqtSignal(object, object)  # проект, изменения, которые не удалось записать
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.queue = queue.Queue()
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                project, changes = item
+                if not project.write_changes(changes):
+                    self.failed.emit(project, changes)
+            finally:
+                self.queue.task_done()
+
+
+class AutoSaver(QObject):
+    """
+    Отложенное сохранение проектов. schedule отмечает проект измененным; через
+    AUTOSAVE_DELAY изменения собираются в потоке интерфейса и записываются
+    в фоновом потоке, поэтому частые подтверждения не ждут диска.
+    flush записывает все сразу и дожидается записи (выход, смена этапа или проекта).
+    """
+
+    def __init__(self, delay=AUTOSAVE_DELAY, parent=None):
+        super().__init__(parent)
+        self.pending = []  # проекты с несохраненными изменениями
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.commit)
+        self.writer = SaveWriter()
+        self.writer.failed.connect(self.write_failed)
+        self.writer.start()
+
+    def schedule(self, project):
+        if project is None:
+            return
+        if project not in self.pending:
+            self.pending.append(project)
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def commit(self):
+        """Передает изменения отмеченных проектов на запись, не дожидаясь ее."""
+        self.timer.stop()
+        for project in self.pending:
+            self.writer.queue.put((project, project.collect_changes()))
+        self.pending = []
+
+    def flush(self):
+        self.commit()
+        self.writer.queue.join()
+
+    def write_failed(self, project, changes):
+        # Изменения снова отмечаются и попадут в следующее сохранение (в том числе flush при выходе)
+        project.restore_changes(changes)
+        self.schedule(project)
+
+    def stop(self):
+        self.flush()
+        self.writer.queue.put(None)
+        self.writer.wait()